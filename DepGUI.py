@@ -11,11 +11,13 @@ Python Version: 3.7, 32 bit
 from PyQt5 import QtWidgets, QtCore, uic, QtGui
 from PyQt5.QtWidgets import QVBoxLayout, QHBoxLayout, QWidget, QPushButton, \
                             QLineEdit, QGroupBox, QGridLayout, QLabel,      \
-                            QCheckBox, QComboBox
+                            QCheckBox, QComboBox, QFileDialog
 from pyqtgraph import PlotWidget, plot
 import pyqtgraph as pg
 import sys  # We need sys so that we can pass argv to QApplication
 import os
+import queue
+from functools import partial
 from random import randint
 
 import numpy as np
@@ -24,11 +26,94 @@ import time
 # Custom Modules
 from monoChromUtility import controlMC
 from picoAmmUtility import controlPA
+from acqWorker import AcqWorker
+from ringBuffer import RingBuffer, PeakDecimator
+from dataLogger import DataLogger
+from dataViewer import openLog, LogPyramid
+from cmdTrace import Tracer, instrument
+from autoRange import AutoRange
+import recipeUtility
+import visaPool
+import stationUtility
+import liveStream
+from sweepEngine import (SweepEngine, PipelinedSweep, waveActuator,
+                         voltActuator, waveMover, voltMover, GridData)
+
+# Instrument backend, set DEPGUI_BACKEND=sim to run on simulated instruments
+# (see instSim.py), or to a pyvisa backend string for the picoammeter
+BACKEND = os.environ.get('DEPGUI_BACKEND', '')
+
+# Set DEPGUI_TRACE to a file name to record every instrument command and
+# export a Chrome trace there when the window closes, see cmdTrace.py
+TRACE = os.environ.get('DEPGUI_TRACE', '')
+
+# Set DEPGUI_STATIONS to a JSON file listing the stations to run, see
+# stationUtility.py, by default one picoammeter at GPIB0::22::INSTR
+STATIONS = stationUtility.load(os.environ.get('DEPGUI_STATIONS', ''))
+
+# Set DEPGUI_STREAM to host:port to serve the live samples to remote viewers,
+# see liveStream.py
+STREAM = os.environ.get('DEPGUI_STREAM', '')
+
+# ----------------------------------------------------------------------------
+# Instruments, acquisition thread and samples of one station
+# ----------------------------------------------------------------------------
+class Station:
+    """ Runs one stationUtility.Station: its picoammeter and monochromator
+        (not connected yet), the AcqWorker reading them on its own QThread,
+        the samples taken so far and their log file """
+
+    def __init__(self, config):
+        self.name = config.name
+        self.hasMono = config.mono is not False
+        self.pico = controlPA(address=config.address, backend=BACKEND,
+                              connect=False)
+        if isinstance(config.mono, str):
+            self.mono = controlMC(libDict=config.mono, backend=BACKEND,
+                                  connect=False)
+        else:
+            self.mono = controlMC(backend=BACKEND, connect=False)
+
+        self.worker = AcqWorker(self.pico, bulk=True)
+        self.thread = QtCore.QThread()
+        self.worker.moveToThread(self.thread)
+        self.thread.started.connect(self.worker.run)
+        self.worker.finished.connect(self.thread.quit)
+
+        # Time, current, voltage, wavelength and range of the last samples
+        self.data = RingBuffer(1e6)
+        self.peaks = PeakDecimator(1e6, block=1000)
+        self.logger = None
+        self.line = None  # Current plot line
+
+        # Parametric study of this station and its GridData for grid scans
+        self.sweep = None
+        self.grid = None
+
+        # Connection, study and last error status text shown for the
+        # selected station
+        self.status = {'mono': 'Not Connected' if self.hasMono else
+                       'Not Used', 'pico': 'Not Connected',
+                       'sweep': 'No Study Running', 'error': 'None'}
+
+    def stop(self):
+        self.worker.stop()
+        self.thread.quit()
+        self.thread.wait()
 
 # ----------------------------------------------------------------------------
 # Define the Main Window of the GUI
 # ----------------------------------------------------------------------------
 class MainWindow(QtWidgets.QMainWindow):
+    # Emitted from an acquisition thread when a connection attempt ends,
+    # with the station index, device name and its connectStatus or the
+    # exception raised
+    connectDone = QtCore.pyqtSignal(int, str, object)
+    # Station index, device name and its new retryUtility.Breaker state,
+    # from any thread
+    breakerChanged = QtCore.pyqtSignal(int, str, str)
+    # A LogPyramid finished building on its own thread
+    pyramidReady = QtCore.pyqtSignal(object)
 
     def __init__(self):
         super(MainWindow, self).__init__()
@@ -48,23 +133,35 @@ class MainWindow(QtWidgets.QMainWindow):
         self.graph_piam.setBackground('w')
         self.graph_volt.setBackground('w')
         self.graph_wave.setBackground('w')
-
-        # Set dummy variables
-        self.time = [time.time() for i in range(100)]  # 100 time points
-        self.piam = [0 for i in range(100)]            # 100 data points
-        self.volt = [0 for i in range(100)]            # 100 data points
-        self.wave = [0 for i in range(100)]            # 100 data points
+        self.graph_data.setBackground('w')
 
         # Add grid to all plots
         self.graph_piam.showGrid(x=True, y=True)
         self.graph_volt.showGrid(x=True, y=True)
         self.graph_wave.showGrid(x=True, y=True)
+        self.graph_data.showGrid(x=True, y=True)
 
-        # Set Data line color
+        # Set Data line color, one current line per station
         pen = pg.mkPen(color=(255, 0, 0))
-        self.piam_line = self.graph_piam.plot(self.time, self.piam, pen=pen)
-        self.volt_line = self.graph_volt.plot(self.time, self.volt, pen=pen)
-        self.wave_line = self.graph_wave.plot(self.time, self.wave, pen=pen)
+        self.stations = [Station(config) for config in STATIONS]
+        if len(self.stations) > 1:
+            self.graph_piam.addLegend()
+        for i, station in enumerate(self.stations):
+            color = pg.intColor(i, hues=len(self.stations))
+            station.line = self.graph_piam.plot([], [], name=station.name,
+                                                pen=pg.mkPen(color=color))
+        self.volt_line = self.graph_volt.plot([], [], pen=pen)
+        self.wave_line = self.graph_wave.plot([], [], pen=pen)
+        self.data_line = self.graph_data.plot([], [], pen=pen)
+        self.saved_data = None
+
+        # Only draw what is visible, peak downsampled to the plot width
+        for line in [station.line for station in self.stations] + [
+                self.volt_line, self.wave_line]:
+            line.setDownsampling(auto=True, method='peak')
+            line.setClipToView(True)
+        for graph in (self.graph_piam, self.graph_volt, self.graph_wave):
+            graph.sigXRangeChanged.connect(self.view_changed)
 
         #  x-axis and y-axis Labels
         self.graph_piam.setLabel('bottom', 'Time [Seconds]')
@@ -73,21 +170,70 @@ class MainWindow(QtWidgets.QMainWindow):
         self.graph_volt.setLabel('left', 'Voltage [V]')
         self.graph_wave.setLabel('bottom', 'Time [Seconds]')
         self.graph_wave.setLabel('left', 'Wavelength [nm]')
+        self.graph_data.setLabel('bottom', 'Time [Seconds]')
+        self.graph_data.setLabel('left', 'Saved Current [Amps]')
+        self.graph_data.sigXRangeChanged.connect(self.update_saved_plot)
+        self.pyramidReady.connect(self.saved_data_ready)
 
         # Group: Connection --------------------------------------------------
         self.mono_conn_status = QLabel('Not Connected')
         self.pico_conn_status = QLabel('Not Connected')
-        self.mono_conn_fun()
-        self.pico_conn_fun()
+        self.error_status = QLabel('None')
+        self.error_status.setWordWrap(True)
+        self.tracer = Tracer() if TRACE else None
+        # Connected in the background once the window is up, see
+        # device_connect
+        self.connectDone.connect(self.conn_done)
+        self.breakerChanged.connect(self.breaker_changed)
+        for index, station in enumerate(self.stations):
+            station.mono.retry.breaker.onChange = partial(
+                self.breakerChanged.emit, index, 'mono')
+            station.pico.retry.breaker.onChange = partial(
+                self.breakerChanged.emit, index, 'pico')
 
         # Group: Data Logging ------------------------------------------------
         self.file_name = ''
         self.save_data_flag = False
+        self.publisher = None
+        if STREAM:
+            try:
+                self.publisher = liveStream.Publisher(
+                    *liveStream.address(STREAM),
+                    channels=[station.name for station in self.stations])
+                print('Streaming samples on port ' +
+                      str(self.publisher.port))
+            except OSError as e:
+                print('Could not stream on ' + STREAM + ': ' + str(e))
 
         # Group: Data and Plottings ------------------------------------------
         self.volt_val = 0
         self.wave_val = 0
         self.curr_ran = 0
+        self.new_data = False
+        self.new_view = False  # Zoomed or panned since the last redraw
+
+        # Acquisition runs in one thread per station, see acqWorker.py
+        for index, station in enumerate(self.stations):
+            station.worker.sampleReady.connect(self.sample_ready)
+            station.worker.error.connect(partial(self.worker_error, index))
+            station.worker.sweepProgress.connect(
+                partial(self.sweep_progress, index))
+            station.worker.sweepFinished.connect(
+                partial(self.sweep_finished, index))
+        self.select_station(0)
+        for index, station in enumerate(self.stations):
+            station.thread.start()
+            self.device_conn(index, 'mono')
+            self.device_conn(index, 'pico')
+
+        # Plot refresh is independent of the instrument cadence, at most
+        # one redraw per plot_period milliseconds
+        self.plot_period = 250
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(self.plot_period)
+        self.timer.timeout.connect(self.update_data)
+        self.timer.timeout.connect(self.update_plot_data)
+        self.timer.start()
 
         #  Define GUI Layout
         layout = QGridLayout()
@@ -115,9 +261,169 @@ class MainWindow(QtWidgets.QMainWindow):
         grid_box = QGridLayout()
         grid_box.addWidget(self.group_sub_para_mono(), 0, 0)
         grid_box.addWidget(self.group_sub_para_pico(), 1, 0)
+        grid_box.addWidget(self.group_sub_para_cont(), 2, 0)
         group_box.setLayout(grid_box)
         return group_box
 
+    # Widget to pause, resume and abort the parametric study of the
+    # selected station, every station runs its own
+    def group_sub_para_cont(self):
+        self.sweep_status = QLabel(self.station.status['sweep'])
+        pause_btn = QPushButton('Pause/Resume', self)
+        pause_btn.clicked.connect(self.sweep_pause_fun)
+        abort_btn = QPushButton('Abort', self)
+        abort_btn.clicked.connect(self.sweep_abort_fun)
+        grid_btn = QPushButton('Run Grid', self)
+        grid_btn.clicked.connect(self.grid_set_fun)
+        recipe_btn = QPushButton('Run Recipe', self)
+        recipe_btn.clicked.connect(self.recipe_run_fun)
+        group_box = QGroupBox('Study Control')
+        grid_box = QGridLayout()
+        grid_box.addWidget(self.sweep_status, 0, 0)
+        grid_box.addWidget(pause_btn, 0, 1)
+        grid_box.addWidget(abort_btn, 0, 2)
+        grid_box.addWidget(grid_btn, 0, 3)
+        grid_box.addWidget(recipe_btn, 0, 4)
+        group_box.setLayout(grid_box)
+        return group_box
+
+    # Study status of the selected station
+    def study_status(self, text):
+        self.set_status(self.stations.index(self.station), 'sweep', text)
+
+    # Check sweep settings, see recipeUtility.py, returns None and shows
+    # the problems when they are invalid
+    def sweep_plan(self, steps):
+        try:
+            return recipeUtility.compilePlan({'steps': steps})
+        except recipeUtility.RecipeError as e:
+            self.study_status(str(e).split('\n')[0])
+            print(e)
+            return None
+
+    def sweep_busy(self):
+        sweep = self.station.sweep
+        if sweep is not None and sweep.active():
+            self.study_status('A parametric study is already running')
+            return True
+        return False
+
+    # Start a study on the selected station's acquisition thread unless it
+    # is already running one
+    def sweep_start(self, points, actuators, movers=None, grid=None):
+        if self.sweep_busy():
+            return
+        station = self.station
+        station.grid = grid
+        if movers is not None and self.pico_inst.connectStatus:
+            # Overlap instrument moves with picoammeter setup and readout
+            target = self.worker.target
+            station.sweep = PipelinedSweep(points, movers, self.pico_inst,
+                                           partial(self.sweep_record,
+                                                   self.worker),
+                                           bulk=self.worker.bulk,
+                                           target=target,
+                                           COUN=100 if target else 20,
+                                           POIN=100 if target else 20,
+                                           autorange=self.worker.autorange)
+        else:
+            station.sweep = SweepEngine(points, actuators,
+                                        self.worker.acquire)
+        self.study_status('Step 0/' + str(len(points)))
+        self.worker.submit(self.worker.runSweep, station.sweep)
+
+    # Runs on the acquisition thread of worker, stores a PipelinedSweep
+    # result
+    def sweep_record(self, worker, point, new_time, result):
+        worker.setTags(**{key + '_val': float(val)
+                          for key, val in point.items()
+                          if key in ('wave', 'volt')})
+        return worker.record(new_time, result)
+
+    # Run a recipe file chosen by the user, see recipeUtility.py
+    def recipe_run_fun(self):
+        file_name = QFileDialog.getOpenFileName(
+            self, 'Open Recipe', '', 'Recipes (*.json *.yaml *.yml)')[0]
+        if not file_name or self.sweep_busy():
+            return
+        try:
+            plan = recipeUtility.compilePlan(recipeUtility.load(file_name))
+        except (recipeUtility.RecipeError, OSError) as e:
+            self.study_status('Invalid recipe, see console')
+            print(e)
+            return
+        if not self.pico_inst.connectStatus:
+            self.study_status('Picoammeter not connected')
+            return
+        station = self.station
+        mono = self.mono if self.mono.connectStatus > 0 else None
+        try:
+            station.sweep = recipeUtility.planSweep(
+                plan, self.pico_inst, mono,
+                partial(self.sweep_record, self.worker))
+        except recipeUtility.RecipeError as e:
+            self.study_status(str(e))
+            return
+        if plan.log:
+            # Only this station's log, the others may be running studies
+            self.file_name = plan.log
+            self.open_logs([station])
+        station.grid = None
+        print(plan.name + ': ' + recipeUtility.describe(plan))
+        self.study_status(recipeUtility.describe(plan))
+        self.worker.submit(self.worker.runSweep, station.sweep)
+
+    def sweep_pause_fun(self):
+        sweep = self.station.sweep
+        if sweep is None:
+            return
+        if sweep.state == 'paused':
+            sweep.resume()
+            self.study_status('Resumed')
+        else:
+            sweep.pause()
+            self.study_status('Paused')
+
+    def sweep_abort_fun(self):
+        if self.station.sweep is not None:
+            self.station.sweep.abort()
+
+    def sweep_progress(self, index, done, total):
+        self.set_status(index, 'sweep',
+                        'Step ' + str(done) + '/' + str(total))
+
+    def sweep_finished(self, index, state):
+        station = self.stations[index]
+        self.set_status(index, 'sweep', 'Study ' + state)
+        if station.grid is not None:
+            station.grid.addResults(station.sweep.results)
+            name = self.file_name or time.strftime('grid_%Y%m%d-%H%M%S')
+            name = stationUtility.logName(name, station, len(self.stations))
+            station.grid.save(os.path.splitext(name)[0] + '_grid.npz')
+
+    # Runs the wavelength x voltage grid set by both rows of QLineEdits
+    def grid_set_fun(self):
+        wave = [self.wave_line_edit_start.text(),
+                self.wave_line_edit_stop.text(),
+                self.wave_line_edit_step.text()]
+        volt = [self.volt_line_edit_start.text(),
+                self.volt_line_edit_stop.text(),
+                self.volt_line_edit_step.text()]
+        plan = self.sweep_plan([{'type': 'grid', 'wave': wave,
+                                 'volt': volt}])
+        if plan is None:
+            return
+        points = [dict(p) for p in plan.points]
+        waves = sorted(set(p['wave'] for p in points))
+        volts = sorted(set(p['volt'] for p in points))
+        print('Grid scan of ' + recipeUtility.describe(plan))
+        self.sweep_start(points,
+                         {'wave': partial(self.sweep_wave, self.station),
+                          'volt': partial(self.sweep_volt, self.station)},
+                         {'wave': waveMover(self.mono),
+                          'volt': voltMover(self.pico_inst)},
+                         grid=GridData(waves, volts))
+
     # Widget to control monochromator wavelength parametric studies
     def group_sub_para_mono(self):
         # Edit Lines for starting stopping and step size for MC wavelength
@@ -164,45 +470,46 @@ class MainWindow(QtWidgets.QMainWindow):
 
     # Function run when wave_para_set_btn is pressed
     def wave_para_set_fun(self):
-        start = int(self.wave_line_edit_start.text())
-        stop  = int(self.wave_line_edit_stop.text())
-        step  = int(self.wave_line_edit_step.text())
-        sweep = [b'GOWAVE ' + str.encode(str(int(i))) for i in np.arange(start, stop+step, step)]
-        wavelength = [str(int(i)) for i in np.arange(start, stop+step, step)]
-        for i in range(len(sweep)):
-            print(sweep[i])
-            self.wave_val = str(str(wavelength[i]))
-            self.wave_val_line.setText(self.wave_val)
-            self.mono.write(sweep[i])
-            self.update_data()
+        plan = self.sweep_plan([{'type': 'wave-sweep',
+                                 'start': self.wave_line_edit_start.text(),
+                                 'stop': self.wave_line_edit_stop.text(),
+                                 'step': self.wave_line_edit_step.text()}])
+        if plan is None:
+            return
+        points = [dict(p) for p in plan.points]
+        self.sweep_start(points,
+                         {'wave': partial(self.sweep_wave, self.station)},
+                         {'wave': waveMover(self.mono)})
         return
 
+    # Runs on the acquisition thread of station
+    def sweep_wave(self, station, wave):
+        waveActuator(station.mono)(wave)
+        station.worker.setTags(wave_val=float(wave))
+
     def volt_para_set_btn(self):
         btn = QPushButton('Run', self)
         btn.clicked.connect(self.volt_para_set_fun)
         return btn
 
     def volt_para_set_fun(self):
-        start = int(self.volt_line_edit_start.text())
-        stop  = int(self.volt_line_edit_stop.text())
-        step  = int(self.volt_line_edit_step.text())
-        sweep1 = ['SOUR:VOLT:RANG ' + str(int(i)) for i in np.arange(start, stop+step, step)]
-        sweep2 = ['SOUR:VOLT ' + str(int(i)) for i in np.arange(start, stop+step, step)]
-        sweep3 = ['SOUR:VOLT?' for i in np.arange(start, stop+step, step)]
-        voltage = [str(int(i)) for i in np.arange(start, stop+step, step)]
-        for i in range(len(sweep1)):
-            print(sweep1[i])
-            print(sweep2[i])
-            self.volt_val = voltage[i]
-            self.pico_inst.inst.write(sweep1[i])
-            time.sleep(0.1)
-            self.pico_inst.inst.write(sweep2[i])
-            time.sleep(0.1)
-            print(self.pico_inst.inst.query(sweep3[i]))
-            self.update_data()
-            self.volt_val_line.setText(voltage[i])
+        plan = self.sweep_plan([{'type': 'volt-sweep',
+                                 'start': self.volt_line_edit_start.text(),
+                                 'stop': self.volt_line_edit_stop.text(),
+                                 'step': self.volt_line_edit_step.text()}])
+        if plan is None:
+            return
+        points = [dict(p) for p in plan.points]
+        self.sweep_start(points,
+                         {'volt': partial(self.sweep_volt, self.station)},
+                         {'volt': voltMover(self.pico_inst)})
         return
 
+    # Runs on the acquisition thread of station
+    def sweep_volt(self, station, volt):
+        voltActuator(station.pico)(volt)
+        station.worker.setTags(volt_val=float(volt))
+
   
     # ------------------------------------------------------------------------
     # Group: Control Functions
@@ -240,15 +547,34 @@ class MainWindow(QtWidgets.QMainWindow):
 
     def mono_shutter(self, text):
         print(b'SHUTTER '+str.encode(text[0]))
-        self.mono.write(b'SHUTTER '+str.encode(text[0]))
+        # On the acquisition thread, between the goWave and recover calls
+        # of sweeps that share the monochromator handle
+        self.worker.submit(self.mono.write, b'SHUTTER '+str.encode(text[0]))
 
     def wave_set_fun(self):
-        print(b'GOWAVE '+str.encode(self.wave_line_edit.text()))
-        self.wave_val = str(self.wave_line_edit.text())
+        wave = self.valid_input(self.wave_line_edit.text(), 'Wavelength',
+                                'wave')
+        if wave is None:
+            return
+        print(b'GOWAVE '+str.encode('{:g}'.format(wave)))
+        self.wave_val = '{:g}'.format(wave)
         self.wave_val_line.setText(self.wave_val)
-        self.mono.write(b'GOWAVE '+str.encode(self.wave_line_edit.text()))
+        self.worker.submit(self.mono.goWave, wave)
+        self.worker.submit(self.worker.setTags, wave_val=wave)
         return
 
+    # Number typed into a QLineEdit, None (and a message) when it is not a
+    # valid setting, limits from recipeUtility.limits
+    def valid_input(self, text, name, key=None, low=None, high=None):
+        if key is not None:
+            low, high = recipeUtility.limits[key]
+        try:
+            return recipeUtility.number(text, name, low, high)
+        except recipeUtility.RecipeError as e:
+            print(e)
+            self.study_status(str(e))
+            return None
+
     # Picoammeter
     def group_pico_cont(self):
         group_box = QGroupBox('Picoammeter')
@@ -270,10 +596,17 @@ class MainWindow(QtWidgets.QMainWindow):
         self.comboBox.addItem('2E-7')
         self.comboBox.addItem('2E-8')
         self.comboBox.addItem('2E-9')
+        self.comboBox.addItem('Auto')
         self.comboBox.activated[str].connect(self.CURR_RANG)
 
         grid_box.addWidget(QLabel('CURR:RANG'), 0, 3)
         grid_box.addWidget(self.comboBox, 0, 4)
+
+        # Adaptive sampling, empty for a fixed number of readings per point
+        self.target_line_edit = QLineEdit()
+        grid_box.addWidget(QLabel('Target SE [%]:'), 1, 0)
+        grid_box.addWidget(self.target_line_edit, 1, 1)
+        grid_box.addWidget(self.target_set_btn(), 1, 2)
         group_box.setLayout(grid_box)
         return group_box
 
@@ -282,24 +615,45 @@ class MainWindow(QtWidgets.QMainWindow):
         btn.clicked.connect(self.volt_set_fun) 
         return btn
 
+    def target_set_btn(self):
+        btn = QPushButton('Set', self)
+        btn.clicked.connect(self.target_set_fun)
+        return btn
+
+    def target_set_fun(self):
+        text = self.target_line_edit.text().strip()
+        target = None
+        if text:
+            target = self.valid_input(text, 'Target SE', low=1e-4, high=100)
+            if target is None:
+                return
+            target /= 100
+        self.worker.submit(self.worker.setTags, target=target)
+
     def CURR_RANG(self, text):
         print('CURR:RANG '+text)
-        self.pico_inst.inst.write('CURR:RANG '+text)
+        if text == 'Auto':
+            # Software autorange, see autoRange.py
+            self.worker.submit(self.worker.setTags, autorange=AutoRange())
+            return
         self.curr_ran = text
-        print(self.pico_inst.inst.query('CURR:RANG?'))
+        self.worker.submit(self.worker.setTags, autorange=None)
+        self.worker.submit(self.curr_rang_write, self.station, text)
+
+    # Runs on the acquisition thread of station
+    def curr_rang_write(self, station, text):
+        station.pico.setRange(text)
+        station.worker.setTags(curr_ran=float(text))
+        print(station.pico.inst.query('CURR:RANG?'))
 
     def volt_set_fun(self):
-        print('SOUR:VOLT '+str(int(self.volt_line_edit.text())))
-        c = 'SOUR:VOLT:RANG ' + str(int(self.volt_line_edit.text()))
-        self.pico_inst.inst.write(c)
-        self.pico_inst.inst.write(c)
-        time.sleep(0.5)
-        c = 'SOUR:VOLT ' + str(int(self.volt_line_edit.text()))
-        self.pico_inst.inst.write(c)
-        time.sleep(0.5)
-        print(self.pico_inst.inst.query('SOUR:VOLT?'))
-        self.volt_val = str(self.volt_line_edit.text())
+        volt = self.valid_input(self.volt_line_edit.text(), 'Voltage', 'volt')
+        if volt is None:
+            return
+        print('SOUR:VOLT '+'{:g}'.format(volt))
+        self.volt_val = '{:g}'.format(volt)
         self.volt_val_line.setText(self.volt_val)
+        self.worker.submit(self.sweep_volt, self.station, volt)
         return
 
     # ------------------------------------------------------------------------
@@ -315,22 +669,97 @@ class MainWindow(QtWidgets.QMainWindow):
         btn.clicked.connect(self.pico_conn_fun)
         return btn
 
+    # Connecting loads the ODevice library or VISA, lists the resources and
+    # resets the instrument, which takes seconds, so it runs on the
+    # station's acquisition thread and reports back through connectDone
     def mono_conn_fun(self):
-        self.mono = controlMC()
-        if self.mono.connectStatus > 0:
-            self.mono_conn_status.setText('Connected')
-        else:
-            self.mono_conn_status.setText('Failed to Connect to Device')
+        self.device_conn(self.stations.index(self.station), 'mono')
         return
 
     def pico_conn_fun(self):
-        self.pico_inst = controlPA()
-        if self.pico_inst.connectStatus:
-            self.pico_conn_status.setText('Connected')
-        else:
-            self.pico_conn_status.setText('Failed to Connect to Device')
+        self.device_conn(self.stations.index(self.station), 'pico')
         return
 
+    def device_conn(self, index, name):
+        station = self.stations[index]
+        if name == 'mono' and not station.hasMono:
+            return
+        device = station.mono if name == 'mono' else station.pico
+        self.set_status(index, name, 'Connecting...')
+        station.worker.submit(self.device_connect, index, name, device)
+
+    # Runs on the acquisition thread
+    def device_connect(self, index, name, device):
+        try:
+            status = device.connect()
+        except Exception as e:
+            self.connectDone.emit(index, name, e)
+            return
+        if self.tracer is not None and status:
+            if name == 'mono':
+                instrument(self.tracer, mono=device)
+            else:
+                instrument(self.tracer, pico=device)
+        self.connectDone.emit(index, name, status)
+
+    def conn_done(self, index, name, status):
+        if isinstance(status, Exception):
+            self.set_status(index, name, 'Failed to Connect: ' + str(status))
+        elif status and status > 0:
+            self.set_status(index, name, 'Connected')
+        else:
+            self.set_status(index, name, 'Failed to Connect to Device')
+
+    # Repeated bus errors pause a device, see retryUtility.Breaker
+    def breaker_changed(self, index, name, state):
+        station = self.stations[index]
+        device = station.mono if name == 'mono' else station.pico
+        if state == 'open':
+            self.set_status(index, name, 'Bus errors, paused for {:.0f} s'
+                            .format(device.retry.breaker.cooldown))
+        elif state == 'half-open':
+            self.set_status(index, name, 'Retrying...')
+        else:
+            self.set_status(index, name, 'Connected')
+
+    # Errors the acquisition thread of a station did not recover from
+    def worker_error(self, index, text):
+        self.set_status(index, 'error', time.strftime('%H:%M:%S ') + text)
+
+    # Connection status of a device ('mono', 'pico'), the study status
+    # ('sweep') or last error ('error') of a station, shown when the station
+    # is selected
+    def set_status(self, index, name, text):
+        station = self.stations[index]
+        station.status[name] = text
+        if station is self.station:
+            if name == 'sweep':
+                label = self.sweep_status
+            elif name == 'error':
+                label = self.error_status
+            elif name == 'mono':
+                label = self.mono_conn_status
+            else:
+                label = self.pico_conn_status
+            label.setText(text)
+
+    # The device controls act on the selected station: self.worker,
+    # self.pico_inst and self.mono are its worker and instruments
+    def select_station(self, index):
+        self.station = self.stations[index]
+        self.worker = self.station.worker
+        self.pico_inst = self.station.pico
+        self.mono = self.station.mono
+
+    def station_changed(self, index):
+        self.select_station(index)
+        self.mono_conn_status.setText(self.station.status['mono'])
+        self.pico_conn_status.setText(self.station.status['pico'])
+        self.sweep_status.setText(self.station.status['sweep'])
+        self.error_status.setText(self.station.status['error'])
+        self.wave_val_line.setText('{:g}'.format(float(self.worker.wave_val)))
+        self.volt_val_line.setText('{:g}'.format(float(self.worker.volt_val)))
+
     def group_conn(self):
         group_box = QGroupBox('Section: Device Connection')
         grid_box = QGridLayout()
@@ -342,6 +771,15 @@ class MainWindow(QtWidgets.QMainWindow):
         grid_box.addWidget(QLabel('Picoammeter Status:  '), 1, 3)
         grid_box.addWidget(self.mono_conn_status, 0, 4)
         grid_box.addWidget(self.pico_conn_status, 1, 4)
+        grid_box.addWidget(QLabel('Last Error:'), 2, 3)
+        grid_box.addWidget(self.error_status, 2, 4)
+        if len(self.stations) > 1:
+            station_cb = QComboBox()
+            for station in self.stations:
+                station_cb.addItem(station.name)
+            station_cb.activated[int].connect(self.station_changed)
+            grid_box.addWidget(QLabel('Station:'), 2, 0)
+            grid_box.addWidget(station_cb, 2, 1)
         group_box.setLayout(grid_box)
         return group_box
 
@@ -365,10 +803,21 @@ class MainWindow(QtWidgets.QMainWindow):
         return btn
 
     def create_file_fun(self):
+        self.open_logs(self.stations)
+        return
+
+    # Binary log, see dataLogger.py for the format and loadLog to read it,
+    # one per station
+    def open_logs(self, stations):
         self.name_data_plot.setText('Saving data to file: '+self.file_name)
-        self.F = open(self.file_name, 'w')
+        for station in stations:
+            if station.logger is not None:
+                station.logger.close()
+            name = stationUtility.logName(self.file_name, station,
+                                          len(self.stations))
+            station.logger = DataLogger(name, flushRows=1000,
+                                        flushInterval=5.0)
         self.save_data_flag = True
-        return
 
     def group_data(self):
         group_box = QGroupBox('Section: Data Logging')
@@ -381,45 +830,74 @@ class MainWindow(QtWidgets.QMainWindow):
         group_box.setLayout(grid_box)
         return group_box
 
+    # Move samples taken by the acquisition thread into the plot data
     def update_data(self):
-        self.time = self.time[1:]            # Remove the first X element.
-        new_time = time.time()
-        self.time.append(new_time)  # Add a new value 1 higher than the last.
-    
-        self.piam = self.piam[1:]         # Remove the first y element
-        if self.pico_inst.connectStatus:
-            new_piam = self.pico_inst.aquireData()
-        else:
-            new_piam = 0
-        self.piam.append(new_piam) # Add a new random value.
-
-        self.volt = self.volt[1:]         # Remove the first y element
-        new_volt = self.volt_val
-        self.volt.append(new_volt) # Add a new random value.
-
-        self.wave = self.wave[1:]  # Remove the first y element
-        new_wave = self.wave_val
-        self.wave.append(new_wave) # Add a new random value
-
-        if self.save_data_flag:
-            print('saving')
-            self.F.write(str(new_time) + '\t' + str(new_piam) + '\t' + str(new_volt) + '\t' + str(new_wave) + '\t' + str(self.curr_ran) + '\n')
-            self.F.flush()
+        for index, station in enumerate(self.stations):
+            sample = None
+            rows = []
+            while True:
+                try:
+                    sample = station.worker.samples.get_nowait()
+                except queue.Empty:
+                    break
+                station.data.append(sample)
+                station.peaks.append(sample)
+                rows.append(sample)
+                if self.save_data_flag and station.logger is not None:
+                    station.logger.append(sample)
+            # Also when acquisition is paused or stalled, so buffered rows
+            # reach the disk within flushInterval
+            if station.logger is not None:
+                station.logger.flushIfDue()
+            if self.publisher is not None:
+                self.publisher.publish(index, rows)
+
+            if sample is not None and station is self.station:
+                new_time, new_piam, new_volt, new_wave, curr_ran, sem = sample
+                self.wave_val_line.setText('{:g}'.format(new_wave))
+                self.volt_val_line.setText('{:g}'.format(new_volt))
+
+    def sample_ready(self):
+        self.new_data = True
+
+    # Only zooming and panning, which turn x autorange off, change what is
+    # drawn; the range changes autorange makes after setData do not
+    def view_changed(self, viewBox, xRange):
+        if not viewBox.autoRangeEnabled()[0]:
+            self.new_view = True
 
     # ------------------------------------------------------------------------
     # Group: Plotting Functions
     # ------------------------------------------------------------------------
     def update_plot_data(self):
-        self.piam_line.setData(self.time, self.piam)
-        self.volt_line.setData(self.time, self.volt)
-        self.wave_line.setData(self.time, self.wave)
-
+        if not (self.new_data or self.new_view):
+            return
+        self.new_data = False
+        self.new_view = False
+        # Current of every station, voltage and wavelength of the selected
+        # one.  Plots that are not shown (volt and wave at the moment) are
+        # skipped
+        lines = [(self.graph_piam, station.line, station, 'piam')
+                 for station in self.stations]
+        lines += [(self.graph_volt, self.volt_line, self.station, 'volt'),
+                  (self.graph_wave, self.wave_line, self.station, 'wave')]
+        for graph, line, station, column in lines:
+            if graph.isVisible():
+                line.setData(*self.plot_trace(graph, station, column))
+
+    # Points for one plot, a constant number however long the history is
+    def plot_trace(self, graph, station, column):
+        data = station.data.view()
+        width = max(graph.width(), 100)
+        if graph.getViewBox().autoRangeEnabled()[0]:
+            return station.peaks.trace(data, column, maxPoints=2*width)
+        x0, x1 = graph.viewRange()[0]
+        return station.peaks.trace(data, column, x0, x1, maxPoints=2*width)
+
+    # Every station acquires at the same time, each on its own thread
     def cont_plot(self, timer):
-        self.timer = QtCore.QTimer()
-        self.timer.setInterval(7*1000)
-        self.timer.timeout.connect(self.update_data)
-        self.timer.timeout.connect(self.update_plot_data)
-        self.timer.start()
+        for station in self.stations:
+            station.worker.resume()
 
     def start_plot_button(self, cont_fun):
         btn = QPushButton('Start/Resume', self)
@@ -430,10 +908,74 @@ class MainWindow(QtWidgets.QMainWindow):
         return btn
 
     def stop_plot(self):
-        self.timer.stop()
-
+        for station in self.stations:
+            station.worker.pause()
+
+    def closeEvent(self, event):
+        for station in self.stations:
+            if station.sweep is not None:
+                station.sweep.abort()
+            station.stop()
+        self.update_data()
+        for station in self.stations:
+            if station.logger is not None:
+                station.logger.close()
+        if self.publisher is not None:
+            self.publisher.close()
+        if self.tracer is not None:
+            self.tracer.exportChrome(TRACE)
+        visaPool.closeAll()
+        super(MainWindow, self).closeEvent(event)
+
+    # Open a saved log without reading it into memory, see dataViewer.py
     def plot_saved_data(self):
-        return
+        file_name = QFileDialog.getOpenFileName(self, 'Open Data File')[0]
+        if not file_name:
+            return
+        try:
+            data = openLog(file_name)
+        except (ValueError, OSError) as e:
+            self.saved_data_status.setText('Could not open: ' + str(e))
+            return
+        if len(data) == 0:
+            self.saved_data_status.setText(os.path.basename(file_name) +
+                                           ' has no samples yet')
+            return
+        # Built in the background the first time a log is opened, drawn
+        # from every n-th sample until then
+        self.saved_data = LogPyramid(data, fileName=file_name,
+                                     background=True,
+                                     onReady=self.pyramidReady.emit)
+        text = os.path.basename(file_name) + ', ' + str(len(data)) + \
+            ' samples'
+        if not self.saved_data.ready:
+            text += ', building overview...'
+        self.saved_data_status.setText(text)
+        self.graph_data.enableAutoRange(x=False)
+        self.graph_data.setXRange(data['time'][0], data['time'][-1])
+        self.update_saved_plot()
+
+    def saved_data_ready(self, pyramid):
+        if pyramid is not self.saved_data:
+            return
+        text = self.saved_data_status.text()
+        self.saved_data_status.setText(text.replace(', building overview...',
+                                                    ''))
+        self.update_saved_plot()
+
+    # Redraw the saved log for the visible range when panning or zooming
+    def update_saved_plot(self):
+        if self.saved_data is None:
+            return
+        x0, x1 = self.graph_data.viewRange()[0]
+        width = max(self.graph_data.width(), 100)
+        x, y = self.saved_data.window(x0, x1, maxPoints=2*width)
+        self.data_line.setData(x, y)
+
+    def plot_saved_btn(self):
+        btn = QPushButton('Load Saved Data', self)
+        btn.clicked.connect(self.plot_saved_data)
+        return btn
 
     def stop_plot_button(self, cont_fun):
         btn = QPushButton('Pause', self)
@@ -456,6 +998,10 @@ class MainWindow(QtWidgets.QMainWindow):
         grid_box.addWidget(self.wave_val_line, 2, 1)
         grid_box.addWidget(QLabel('Voltage: '), 2, 2)
         grid_box.addWidget(self.volt_val_line, 2, 3)
+        self.saved_data_status = QLabel('No Saved Data Loaded')
+        grid_box.addWidget(self.plot_saved_btn(), 3, 0, 1, 2)
+        grid_box.addWidget(self.saved_data_status, 3, 2, 1, 2)
+        grid_box.addWidget(self.graph_data, 4, 0, 1, 4)
         group_box.setLayout(grid_box)
         return group_box
     # End of Updating Plot Section -------------------------------------------
@@ -0,0 +1,154 @@
+"""
+Acquisition loop of one station, run by AcqWorker on its own QThread so
+the GUI never waits on the instruments.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+from PyQt5 import QtCore
+import queue
+import time
+
+from ringBuffer import sampleRows
+from retryUtility import CircuitOpen
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class AcqWorker(QtCore.QObject):
+    """ Runs picoammeter acquisitions off the GUI thread.
+
+        Move to a QThread and connect QThread.started to run.  Samples are
+        put on self.samples as (time, current, voltage, wavelength, range,
+        standard error) tuples and announced with sampleReady.  With bulk set
+        every reading in the picoammeter buffer becomes a sample, stamped
+        with the instrument's own reading times.  With target set the number
+        of readings per point adapts to the noise, see
+        controlPA.aquireAdaptive, with autorange set the current range is
+        picked by an autoRange.AutoRange.  Anything else that talks to
+        the instruments should be passed to submit so it runs between
+        acquisitions instead of on the GPIB bus at the same time.
+    """
+    sampleReady = QtCore.pyqtSignal()
+    error = QtCore.pyqtSignal(str)
+    sweepProgress = QtCore.pyqtSignal(int, int)
+    sweepFinished = QtCore.pyqtSignal(str)
+    finished = QtCore.pyqtSignal()
+
+    def __init__(self, pico=None, interval=0.5, bulk=False, target=None):
+        super(AcqWorker, self).__init__()
+        self.pico = pico
+        self.interval = interval  # Minimum seconds between continuous points
+        self.bulk = bulk          # Queue every buffered reading, not the mean
+        self.target = target      # Relative standard error, None for fixed
+        self.autorange = None     # AutoRange, None for the range set by hand
+        self.samples = queue.Queue()
+        self.jobs = queue.Queue()
+        self.running = False      # Continuous acquisition on/off
+        self.alive = True
+
+        # Values stored with each sample, set through setTags
+        self.volt_val = 0
+        self.wave_val = 0
+        self.curr_ran = 0
+
+    def run(self):
+        last = 0
+        while self.alive:
+            # Jobs take priority, when acquiring continuously only wait on the
+            # job queue until the next point is due
+            if self.running:
+                wait = max(last + self.interval - time.time(), 0)
+            else:
+                wait = 0.05
+            try:
+                func, args, kwargs = self.jobs.get(timeout=wait)
+            except queue.Empty:
+                func = None
+
+            try:
+                if func is not None:
+                    func(*args, **kwargs)
+                elif self.running:
+                    last = time.time()
+                    self.acquire()
+            except CircuitOpen:
+                pass  # Shown by the breaker state, tried after the cooldown
+            except Exception as e:
+                print('Acquisition error: ' + repr(e))
+                self.error.emit(repr(e))
+        self.finished.emit()
+
+    def acquire(self):
+        """ Take one point, returns the (mean) sample """
+        new_time = time.time()
+        connected = self.pico is not None and self.pico.connectStatus
+        if not connected:
+            return self.record(new_time, 0)
+        if self.target:
+            measure = lambda: self.pico.aquireAdaptive(self.target)
+        elif self.bulk:
+            measure = self.pico.aquireBuffer
+        else:
+            measure = self.pico.aquireData
+        if self.autorange is not None:
+            key = (('volt', self.volt_val), ('wave', self.wave_val))
+            result = self.autorange.acquire(self.pico, key, measure)
+        else:
+            result = measure()
+        return self.record(new_time, result)
+
+    def record(self, new_time, result):
+        """ Queue the samples of one acquisition started at new_time
+
+            Input:
+
+              new_time: Seconds since the epoch
+
+                result: Mean current, or BufferData whose readings each
+                        become a sample when bulk is set
+
+            Output: (mean) sample
+        """
+        if getattr(self.pico, 'range', None):
+            self.curr_ran = self.pico.range  # Range actually used
+        sample, rows = sampleRows(new_time, result, self.volt_val,
+                                  self.wave_val, self.curr_ran, self.bulk)
+        for row in rows:
+            self.samples.put(row)
+        self.sampleReady.emit()
+        return sample
+
+    def runSweep(self, engine):
+        """ Run a SweepEngine here, queued jobs still run while it is paused
+        """
+        engine.onProgress = self.sweepProgress.emit
+        engine.onFinish = self.sweepFinished.emit
+        engine.onIdle = self.runPending
+        engine.run()
+
+    def runPending(self):
+        while True:
+            try:
+                func, args, kwargs = self.jobs.get_nowait()
+            except queue.Empty:
+                return
+            func(*args, **kwargs)
+
+    def submit(self, func, *args, **kwargs):
+        self.jobs.put((func, args, kwargs))
+
+    def setTags(self, **kwargs):
+        for key, val in kwargs.items():
+            setattr(self, key, val)
+
+    def resume(self):
+        self.running = True
+
+    def pause(self):
+        self.running = False
+
+    def stop(self):
+        self.running = False
+        self.alive = False
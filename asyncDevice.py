@@ -0,0 +1,41 @@
+"""
+DeviceExecutor, the thread of one instrument behind the asyncio variants of
+the controlPA and controlMC calls.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import asyncio
+import concurrent.futures
+import functools
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class DeviceExecutor:
+    """ Runs the blocking calls of one instrument on its own thread.
+
+        pyvisa and ODevice.dll calls block, so the async methods of controlPA
+        and controlMC hand them to call, which runs them one at a time on a
+        thread belonging to the instrument and lets the event loop carry on
+        meanwhile.  Waiting between calls is done with asyncio.sleep on the
+        loop, so two instruments can be driven at once from one thread.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.pool = None
+
+    async def call(self, func, *args, **kwargs):
+        """ Await func(*args, **kwargs) run on the instrument thread """
+        if self.pool is None:
+            self.pool = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix=self.name)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.pool, functools.partial(func, *args, **kwargs))
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
@@ -0,0 +1,117 @@
+"""
+Runs an asyncio event loop inside the Qt event loop, so coroutines such as
+asyncSweep or the *Async methods of controlPA and controlMC can be started
+from the GUI thread of a Qt script without blocking it.  qasync is used when
+it is installed, otherwise a QTimer steps the asyncio loop.  DepGUI does not
+use it, its instruments are only driven by the AcqWorker of each station.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+from PyQt5 import QtCore
+import asyncio
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class TimerLoop:
+    """ Steps an asyncio loop from a QTimer, for when qasync is missing.
+
+        Each timeout runs the callbacks that are ready and returns, so ready
+        coroutines wait at most interval ms and the GUI never blocks on
+        them.  The timer only runs while tasks are pending, submit starts
+        it again.
+    """
+    def __init__(self, interval=5):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.timer = QtCore.QTimer()
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.step)
+
+    def wake(self):
+        """ Step the loop until its tasks are done, from the GUI thread """
+        if not self.timer.isActive():
+            self.timer.start()
+
+    def step(self):
+        #  One more step after the last task finished runs its done
+        #  callbacks
+        idle = not asyncio.all_tasks(self.loop)
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()
+        if idle and not asyncio.all_tasks(self.loop):
+            self.timer.stop()
+
+    def close(self):
+        self.timer.stop()
+        self.loop.close()
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+_loop = None
+_timer = None  # TimerLoop when qasync is not installed
+
+
+def install(app):
+    """ Start an asyncio loop driven by the Qt event loop of app
+
+        Input:
+
+          app: QApplication
+
+        Output: asyncio event loop
+    """
+    global _loop, _timer
+    if _loop is not None:
+        return _loop
+    try:
+        import qasync
+    except ImportError:
+        _timer = TimerLoop()
+        _loop = _timer.loop
+    else:
+        _loop = qasync.QEventLoop(app)
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def run(app):
+    """ Run the Qt event loop, and with it the installed asyncio loop, until
+        the application quits, replaces app.exec_() """
+    loop = install(app)
+    if _timer is not None:
+        return app.exec_()
+    with loop:
+        loop.run_forever()  # qasync runs app.exec_()
+    return 0
+
+
+def submit(coro, done=None):
+    """ Schedule a coroutine on the installed loop
+
+        Input:
+
+          coro: Coroutine object, e.g. mono.goWaveAsync(400)
+
+          done: Optional done(result) called on the GUI thread when it
+                finishes, exceptions are printed
+
+        Output: asyncio.Task, cancel it to abort
+    """
+    loop = install(QtCore.QCoreApplication.instance())
+    task = asyncio.ensure_future(coro, loop=loop)
+    if _timer is not None:
+        _timer.wake()
+
+    def finished(task):
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            print('Async error: ' + repr(task.exception()))
+        elif done is not None:
+            done(task.result())
+    task.add_done_callback(finished)
+    return task
@@ -0,0 +1,131 @@
+"""
+Software autorange of the 6487 current range, with the range last used at
+each setpoint cached for the next visit.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import collections
+
+# ----------------------------------------------------------------------------
+# Keithley 6487 current ranges
+# ----------------------------------------------------------------------------
+currentRanges = [2e-9, 2e-8, 2e-7, 2e-6, 2e-5, 2e-4, 2e-3, 2e-2]  # Amps
+
+#  Value the 6487 returns for a reading above 105% of the range
+OVERFLOW = 9.9e37
+
+
+def pickRange(level, headroom=0.8):
+    """ Smallest range that holds level with headroom to spare
+
+        Input:
+
+             level: Expected current in Amps
+
+          headroom: Fraction of the range the level may use
+
+        Output: Range in Amps
+    """
+    for rang in currentRanges:
+        if abs(level) <= headroom*rang:
+            return rang
+    return currentRanges[-1]
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class AutoRange:
+    """ Software autorange for controlPA.
+
+        The 6487's own autorange (CURR:RANGE:AUTO ON) steps through the
+        ranges on every trigger, which is slow, so aquireData keeps it off.
+        Instead the last level measured at each setpoint, e.g. (wavelength,
+        voltage), is cached and the range is picked from it before measuring.
+        The range is only changed when the prediction differs from the
+        current one, and a point is measured again when it overflowed or used
+        less than a fraction under of the range.
+    """
+    def __init__(self, headroom=0.8, under=0.02, size=1024):
+        self.headroom = headroom  # Fraction of the range a level may use
+        self.under = under        # Re-measure below this fraction of range
+        self.size = size          # Setpoints remembered
+        self.levels = collections.OrderedDict()  # key: last |mean| in Amps
+        self.last = None          # Most recent level at any setpoint
+
+    def predict(self, key):
+        """ Expected level at key, None if nothing was measured yet """
+        return self.levels.get(key, self.last)
+
+    def select(self, pico, key):
+        """ Switch pico to the range predicted for key, returns the range """
+        level = self.predict(key)
+        if level is None:
+            rang = pico.range or currentRanges[-1]
+        else:
+            rang = pickRange(level, self.headroom)
+        if rang != pico.range:
+            pico.setRange(rang)
+        return rang
+
+    def check(self, pico, result):
+        """ Range to measure result again with, None when it is fine
+
+            Input:
+
+                pico: controlPA result was measured with
+
+              result: Mean current or BufferData
+
+            Output: Range in Amps or None
+        """
+        read = np.abs(getattr(result, 'read', result))
+        rang = pico.range or currentRanges[-1]
+        if np.any(read >= OVERFLOW) or np.any(read > 1.05*rang):
+            bigger = [r for r in currentRanges if r > rang]
+            return bigger[0] if bigger else None
+        level = abs(getattr(result, 'mean', result))
+        if level < self.under*rang:
+            smaller = pickRange(level, self.headroom)
+            return smaller if smaller < rang else None
+        return None
+
+    def update(self, key, result):
+        """ Remember the level of an in-range result measured at key """
+        level = abs(getattr(result, 'mean', result))
+        if level >= OVERFLOW:
+            return
+        self.levels.pop(key, None)
+        self.levels[key] = level
+        if len(self.levels) > self.size:
+            self.levels.popitem(last=False)
+        self.last = level
+
+    def acquire(self, pico, key, measure):
+        """ Measure at key with the predicted range, re-measuring on a
+            better range when the result was out of range
+
+            Input:
+
+                 pico: controlPA
+
+                  key: Setpoint, any hashable such as (wave, volt)
+
+              measure: Function taking the measurement, e.g.
+                       pico.aquireBuffer
+
+            Output: Result of measure, pico.range is the range it used
+        """
+        self.select(pico, key)
+        tried = set()
+        while True:
+            tried.add(pico.range)
+            result = measure()
+            rang = self.check(pico, result)
+            if rang is None or rang in tried:
+                break
+            pico.setRange(rang)
+        self.update(key, result)
+        return result
@@ -0,0 +1,320 @@
+"""
+Headless throughput benchmark of the measurement loop.  Runs the same steps
+as MainWindow.update_data (acquire, ring buffer, plot decimation, binary log)
+and both parametric sweeps on the simulated instruments by default, e.g.
+
+    python benchAcq.py --points 200
+    python benchAcq.py --compare bench_results/<earlier run>.json
+    python benchAcq.py --stations 4
+
+Results are written to bench_results/ as JSON, named after the git commit.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from picoAmmUtility import controlPA
+from monoChromUtility import controlMC
+from ringBuffer import RingBuffer, PeakDecimator
+from dataLogger import DataLogger
+from sweepEngine import (SweepEngine, PipelinedSweep, sweepPoints,
+                         waveActuator, voltActuator, waveMover, voltMover,
+                         asyncSweep)
+from cmdTrace import Tracer, instrument
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class StageTimer:
+    """ Collects durations per named stage """
+
+    def __init__(self):
+        self.times = {}
+
+    def add(self, stage, seconds):
+        self.times.setdefault(stage, []).append(seconds)
+
+    def summary(self):
+        out = {}
+        for stage, values in self.times.items():
+            values = np.array(values)*1e3
+            out[stage] = {'count': len(values),
+                          'total_ms': float(values.sum()),
+                          'p50_ms': float(np.percentile(values, 50)),
+                          'p90_ms': float(np.percentile(values, 90)),
+                          'p99_ms': float(np.percentile(values, 99)),
+                          'max_ms': float(values.max())}
+        return out
+
+# ----------------------------------------------------------------------------
+# Benchmarks
+# ----------------------------------------------------------------------------
+def benchTimeSeries(pico, points, bulk, logName, history=int(1e6)):
+    """ Time series loop, one acquisition per point """
+    timer = StageTimer()
+    data = RingBuffer(history)
+    peaks = PeakDecimator(history)
+    logger = DataLogger(logName)
+    samples = 0
+    memory = []  # Traced memory after each point, buffers are preallocated
+
+    start = time.perf_counter()
+    for i in range(points):
+        t0 = time.perf_counter()
+        now = time.time()
+        if bulk:
+            buf = pico.aquireBuffer()
+            rows = [(now + s, r, 0., 0., 0., buf.sem)
+                    for s, r in zip(buf.time, buf.read)]
+        else:
+            rows = [(now, pico.aquireData(), 0., 0., 0., np.nan)]
+        t1 = time.perf_counter()
+        for row in rows:
+            data.append(row)
+            peaks.append(row)
+        t2 = time.perf_counter()
+        for row in rows:
+            logger.append(row)
+        t3 = time.perf_counter()
+        peaks.trace(data.view(), 'piam', maxPoints=2000)
+        t4 = time.perf_counter()
+
+        timer.add('acquire', t1 - t0)
+        timer.add('buffer', t2 - t1)
+        timer.add('log', t3 - t2)
+        timer.add('plot', t4 - t3)
+        samples += len(rows)
+        memory.append(tracemalloc.get_traced_memory()[0])
+    elapsed = time.perf_counter() - start
+    logger.close()
+
+    return {'points': points, 'samples': samples, 'seconds': elapsed,
+            'points_per_s': points/elapsed, 'samples_per_s': samples/elapsed,
+            'memory_mb': memory[-1]/2**20,
+            'memory_growth_mb': (memory[-1] - memory[0])/2**20,
+            'stages': timer.summary()}
+
+
+def benchSweep(points, actuators, acquire, settle):
+    """ One parametric sweep through SweepEngine """
+    timer = StageTimer()
+
+    def timed(stage, func):
+        def wrapper(*args):
+            t0 = time.perf_counter()
+            out = func(*args)
+            timer.add(stage, time.perf_counter() - t0)
+            return out
+        return wrapper
+
+    engine = SweepEngine(points,
+                         {k: timed('move', f) for k, f in actuators.items()},
+                         timed('acquire', acquire), settle=settle)
+    start = time.perf_counter()
+    engine.run()
+    elapsed = time.perf_counter() - start
+    return {'steps': len(points), 'seconds': elapsed,
+            'steps_per_s': len(points)/elapsed, 'state': engine.state,
+            'stages': timer.summary()}
+
+
+def benchPipelined(points, movers, pico, settle, bulk):
+    """ The same sweep through PipelinedSweep """
+    timer = StageTimer()
+
+    def timed(stage, func):
+        def wrapper(*args):
+            t0 = time.perf_counter()
+            out = func(*args)
+            timer.add(stage, time.perf_counter() - t0)
+            return out
+        return wrapper
+
+    movers = {k: (timed('move', start), timed('wait', wait))
+              for k, (start, wait) in movers.items()}
+    engine = PipelinedSweep(points, movers, pico, lambda *args: None,
+                            settle=settle, bulk=bulk)
+    start = time.perf_counter()
+    engine.run()
+    elapsed = time.perf_counter() - start
+    return {'steps': len(points), 'seconds': elapsed,
+            'steps_per_s': len(points)/elapsed, 'state': engine.state,
+            'stages': timer.summary()}
+
+
+def benchAsync(points, pico, mono, settle, bulk):
+    """ The same sweep through asyncSweep """
+    start = time.perf_counter()
+    asyncio.run(asyncSweep(points, pico, mono, lambda *args: None,
+                           settle=settle, bulk=bulk))
+    elapsed = time.perf_counter() - start
+    return {'steps': len(points), 'seconds': elapsed,
+            'steps_per_s': len(points)/elapsed, 'state': 'done',
+            'stages': {}}
+
+
+def benchStations(picos, points, bulk):
+    """ Time series on every picoammeter at once, one thread each as the
+        GUI runs its stations """
+    acquire = 'aquireBuffer' if bulk else 'aquireData'
+
+    def loop(pico):
+        for i in range(points):
+            getattr(pico, acquire)()
+
+    threads = [threading.Thread(target=loop, args=(pico,)) for pico in picos]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    total = points*len(picos)
+    return {'stations': len(picos), 'points': total, 'seconds': elapsed,
+            'points_per_s': total/elapsed,
+            'points_per_s_per_station': total/elapsed/len(picos),
+            'stages': {}}
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(args):
+    addresses = ['GPIB' + str(i) + '::22::INSTR' for i in range(args.stations)]
+    if args.backend == 'sim':
+        import instSim
+        instSim.config['addresses'] = addresses
+    pico = controlPA(backend=args.backend, mode=args.mode)
+    mono = controlMC(backend=args.backend)
+    results = {'commit': gitCommit(), 'created': time.time(),
+               'settings': vars(args).copy()}
+    tracer = None
+    if args.trace:
+        tracer = Tracer()
+        instrument(tracer, pico=pico, mono=mono)
+
+    tracemalloc.start()
+    logName = os.path.join(tempfile.mkdtemp(), 'bench.dlog')
+    results['timeseries'] = benchTimeSeries(pico, args.points, args.bulk,
+                                            logName)
+    os.remove(logName)
+
+    acquire = pico.aquireBuffer if args.bulk else pico.aquireData
+    waves = [{'wave': w} for w in sweepPoints(*args.wave)]
+    volts = [{'volt': v} for v in sweepPoints(*args.volt)]
+    if args.asyncio:
+        results['wave_sweep'] = benchAsync(waves, pico, mono, args.settle,
+                                           args.bulk)
+        results['volt_sweep'] = benchAsync(volts, pico, mono, args.settle,
+                                           args.bulk)
+    elif args.pipeline:
+        results['wave_sweep'] = benchPipelined(
+            waves, {'wave': waveMover(mono)}, pico, args.settle, args.bulk)
+        results['volt_sweep'] = benchPipelined(
+            volts, {'volt': voltMover(pico)}, pico, args.settle, args.bulk)
+    else:
+        results['wave_sweep'] = benchSweep(
+            waves, {'wave': waveActuator(mono)}, acquire, args.settle)
+        results['volt_sweep'] = benchSweep(
+            volts, {'volt': voltActuator(pico)}, acquire, args.settle)
+    tracemalloc.stop()
+    if args.stations > 1:
+        picos = [pico] + [controlPA(address, backend=args.backend,
+                                    mode=args.mode)
+                          for address in addresses[1:]]
+        results['stations'] = benchStations(picos, args.points, args.bulk)
+    if tracer is not None:
+        results['commands'] = tracer.summary()
+        tracer.exportChrome(args.trace)
+    return results
+
+
+def report(results, old=None):
+    def line(name, new, ref):
+        text = '  {:<28s}{:>12.3f}'.format(name, new)
+        if ref:
+            text += '  ({:+.1f}%)'.format(100*(new - ref)/ref)
+        return text
+
+    for section in ('timeseries', 'wave_sweep', 'volt_sweep', 'stations'):
+        if section not in results:
+            continue
+        new = results[section]
+        ref = old.get(section, {}) if old else {}
+        print(section)
+        for key in ('points_per_s', 'points_per_s_per_station',
+                    'samples_per_s', 'steps_per_s', 'seconds', 'memory_mb',
+                    'memory_growth_mb'):
+            if key in new:
+                print(line(key, new[key], ref.get(key)))
+        for stage, stats in new['stages'].items():
+            refStats = ref.get('stages', {}).get(stage, {})
+            for key in ('p50_ms', 'p90_ms', 'p99_ms'):
+                print(line(stage + ' ' + key, stats[key], refStats.get(key)))
+
+# ----------------------------------------------------------------------------
+# Run benchmark here if main file
+# ----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--points', type=int, default=100,
+                        help='time series points (default 100)')
+    parser.add_argument('--backend', default='sim',
+                        help="instrument backend (default 'sim')")
+    parser.add_argument('--mode', default='poll',
+                        help='controlPA acquisition mode (default poll)')
+    parser.add_argument('--bulk', action='store_true',
+                        help='read the whole buffer with aquireBuffer')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='run the sweeps with PipelinedSweep')
+    parser.add_argument('--async', dest='asyncio', action='store_true',
+                        help='run the sweeps with asyncSweep')
+    parser.add_argument('--wave', type=int, nargs=3, default=[325, 700, 25],
+                        metavar=('START', 'STOP', 'STEP'))
+    parser.add_argument('--volt', type=int, nargs=3, default=[0, 100, 10],
+                        metavar=('START', 'STOP', 'STEP'))
+    parser.add_argument('--settle', type=float, default=0.1,
+                        help='sweep settling time in seconds (default 0.1)')
+    parser.add_argument('--stations', type=int, default=1,
+                        help='also time N picoammeters read at once, at '
+                        'GPIB0::22::INSTR, GPIB1::22::INSTR, ...')
+    parser.add_argument('--out', default='bench_results',
+                        help='directory for the JSON results')
+    parser.add_argument('--compare', help='earlier results file to compare to')
+    parser.add_argument('--trace', help='export a Chrome trace of every '
+                        'instrument command to this file')
+    args = parser.parse_args()
+
+    results = run(args)
+    old = None
+    if args.compare:
+        with open(args.compare) as F:
+            old = json.load(F)
+    report(results, old)
+
+    if not os.path.isdir(args.out):
+        os.makedirs(args.out)
+    fileName = os.path.join(args.out, time.strftime('%Y%m%d-%H%M%S') +
+                            '_' + results['commit'] + '.json')
+    with open(fileName, 'w') as F:
+        json.dump(results, F, indent=2)
+    print('Saved ' + fileName)
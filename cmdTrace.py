@@ -0,0 +1,208 @@
+"""
+Timing of every SCPI command, ODevice call and sleep, exported as a Chrome
+trace.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import collections
+import json
+import os
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class Tracer:
+    """ Records timed events and exports them as a Chrome trace.
+
+        Open the exported file in chrome://tracing or https://ui.perfetto.dev
+        to see every SCPI command, ODevice call and sleep on a timeline, one
+        row per thread.  Only the last maxEvents events are kept, so tracing
+        a long run does not grow without bound.
+    """
+    def __init__(self, maxEvents=200000):
+        self.events = collections.deque(maxlen=maxEvents)
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def record(self, name, cat, begin, end, **args):
+        event = {'name': name, 'cat': cat, 'ph': 'X',
+                 'ts': (begin - self.start)*1e6, 'dur': (end - begin)*1e6,
+                 'pid': os.getpid(), 'tid': threading.current_thread().name,
+                 'args': args}
+        with self.lock:
+            self.events.append(event)
+
+    def call(self, name, cat, func, *args, **kwargs):
+        """ Run func, recording its duration and any exception """
+        begin = time.perf_counter()
+        try:
+            out = func(*args, **kwargs)
+        except Exception as e:
+            self.record(name, cat, begin, time.perf_counter(), error=repr(e))
+            raise
+        self.record(name, cat, begin, time.perf_counter())
+        return out
+
+    def summary(self):
+        """ Count, total and maximum milliseconds per event name """
+        out = {}
+        with self.lock:
+            events = list(self.events)
+        for event in events:
+            stats = out.setdefault(event['name'], {'count': 0, 'total_ms': 0.,
+                                                   'max_ms': 0., 'errors': 0})
+            stats['count'] += 1
+            stats['total_ms'] += event['dur']/1e3
+            stats['max_ms'] = max(stats['max_ms'], event['dur']/1e3)
+            stats['errors'] += 'error' in event['args']
+        return out
+
+    def exportChrome(self, fileName):
+        with self.lock:
+            events = list(self.events)
+        with open(fileName, 'w') as F:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, F)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+
+
+class TracedResource:
+    """ Wraps a pyvisa resource, timing every write and query """
+
+    def __init__(self, inst, tracer, cat='controlPA'):
+        self.__dict__['inst'] = inst
+        self.__dict__['tracer'] = tracer
+        self.__dict__['cat'] = cat
+
+    def __getattr__(self, name):
+        return getattr(self.inst, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.inst, name, value)  # e.g. timeout
+
+    def _traced(self, name, func, *args, **kwargs):
+        begin = time.perf_counter()
+        try:
+            out = func(*args, **kwargs)
+        except Exception as e:
+            self.tracer.record(name, self.cat, begin, time.perf_counter(),
+                               error=repr(e))
+            raise
+        end = time.perf_counter()
+        if isinstance(out, str):
+            size = len(out)
+        elif hasattr(out, '__len__'):
+            size = 4*len(out)
+        else:
+            size = 0
+        self.tracer.record(name, self.cat, begin, end,
+                           sent=len(args[0]) if args else 0, received=size)
+        return out
+
+    def write(self, message, *args, **kwargs):
+        return self._traced(message, self.inst.write, message, *args, **kwargs)
+
+    def query(self, message, *args, **kwargs):
+        return self._traced(message, self.inst.query, message, *args, **kwargs)
+
+    def query_binary_values(self, message, *args, **kwargs):
+        return self._traced(message, self.inst.query_binary_values, message,
+                            *args, **kwargs)
+
+    def read(self, *args, **kwargs):
+        return self._traced('read', self.inst.read, *args, **kwargs)
+
+    def wait_for_srq(self, *args, **kwargs):
+        return self._traced('wait_for_srq', self.inst.wait_for_srq, *args,
+                            **kwargs)
+
+
+class TracedLib:
+    """ Wraps the ODevice library handle, timing every call """
+
+    def __init__(self, lib, tracer, cat='controlMC'):
+        self.lib = lib
+        self.tracer = tracer
+        self.cat = cat
+
+    def __getattr__(self, name):
+        func = getattr(self.lib, name)
+        if not callable(func):
+            return func
+
+        def traced(*args):
+            text = b''
+            if args and hasattr(args[0], 'value'):
+                text = bytes(args[0].value)
+            label = name + ' ' + text.decode(errors='replace') if (
+                name == 'odev_write') else name
+            begin = time.perf_counter()
+            try:
+                out = func(*args)
+            except Exception as e:
+                self.tracer.record(label, self.cat, begin, time.perf_counter(),
+                                   error=repr(e))
+                raise
+            self.tracer.record(label, self.cat, begin, time.perf_counter(),
+                               sent=len(text) if name == 'odev_write' else 0,
+                               returned=out if isinstance(out, int) else None)
+            return out
+        return traced
+
+
+class TracedTime:
+    """ Stands in for the time module as the clock of one controlPA so its
+        sleeps show up in the trace """
+
+    def __init__(self, tracer, cat):
+        self.tracer = tracer
+        self.cat = cat
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        if seconds > 0:
+            self.tracer.call('sleep', self.cat, time.sleep, seconds)
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def instrument(tracer, pico=None, mono=None):
+    """ Start tracing the given controlPA and controlMC instances
+
+        Input:
+
+          tracer: Tracer the events are recorded in
+
+            pico: controlPA, its session, acquisitions and sleeps are traced
+
+            mono: controlMC, its ODevice calls are traced
+
+        Output: None
+    """
+    if pico is not None and getattr(pico, 'connectStatus', False):
+        if not isinstance(pico.inst, TracedResource):
+            pico.inst = TracedResource(pico.inst, tracer)
+        for name in ('aquireData', 'aquireBuffer', 'arm', 'measure',
+                     'waitBufferFull'):
+            func = getattr(type(pico), name, None)
+            if func is not None and name not in pico.__dict__:
+                setattr(pico, name, _tracedMethod(tracer, pico, name, func))
+        if not isinstance(pico.clock, TracedTime):
+            pico.clock = TracedTime(tracer, 'controlPA')
+    if mono is not None and not isinstance(mono.lib, TracedLib):
+        mono.lib = TracedLib(mono.lib, tracer)
+
+
+def _tracedMethod(tracer, obj, name, func):
+    def traced(*args, **kwargs):
+        return tracer.call(name, type(obj).__name__, func, obj, *args,
+                           **kwargs)
+    return traced
@@ -0,0 +1,132 @@
+"""
+Buffered binary sample logs: DataLogger writes them, readHeader and
+loadLog read them back.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import json
+import struct
+import time
+
+from ringBuffer import sampleDtype
+
+# ----------------------------------------------------------------------------
+# File layout
+#
+#   8 bytes   magic, b'DEPLOG1\n'
+#   4 bytes   little endian uint32, length of the JSON header
+#   N bytes   JSON header: columns, units, dtype and creation time, padded
+#             with spaces so the records start on a 64 byte boundary
+#   ...       packed little endian records of the header dtype
+#
+# Rows are only ever appended, a file cut short by a crash loses at most the
+# rows that were still buffered.
+# ----------------------------------------------------------------------------
+MAGIC = b'DEPLOG1\n'
+
+sampleUnits = {'time': 's', 'piam': 'A', 'volt': 'V', 'wave': 'nm',
+               'rang': 'A', 'sem': 'A'}
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class DataLogger:
+    """ Buffered writer for binary deposition logs.
+
+        Rows are collected in memory and written once flushRows have been
+        collected or flushInterval seconds have passed since the last write.
+        The time is only checked by append and flushIfDue, call flushIfDue
+        regularly when rows may stop arriving (e.g. from a GUI timer).
+    """
+    def __init__(self, fileName, dtype=sampleDtype, units=sampleUnits,
+                 flushRows=1000, flushInterval=5.0):
+        self.fileName = fileName
+        self.dtype = np.dtype(dtype).newbyteorder('<')
+        self.flushRows = int(flushRows)
+        self.flushInterval = flushInterval
+
+        self.buffer = np.zeros(self.flushRows, dtype=self.dtype)
+        self.count = 0
+        self.rows = 0  # Rows written to disk
+        self.lastFlush = time.time()
+
+        header = {'columns': list(self.dtype.names),
+                  'units': dict(units),
+                  'dtype': self.dtype.descr,
+                  'created': time.time()}
+        text = json.dumps(header).encode()
+        pad = -(len(MAGIC) + 4 + len(text)) % 64
+        text = text + b' '*pad
+
+        self.F = open(fileName, 'wb')
+        self.F.write(MAGIC + struct.pack('<I', len(text)) + text)
+        self.F.flush()
+
+    def append(self, row):
+        """ Add one row, a tuple in dtype field order """
+        self.buffer[self.count] = row
+        self.count += 1
+        if self.count == self.flushRows:
+            self.flush()
+        else:
+            self.flushIfDue()
+
+    def flushIfDue(self):
+        """ Write the buffered rows if flushInterval seconds have passed
+            since the last write """
+        if self.count and time.time() - self.lastFlush > self.flushInterval:
+            self.flush()
+
+    def extend(self, rows):
+        """ Add an array of rows """
+        rows = np.asarray(rows, dtype=self.dtype)
+        self.flush()
+        self.F.write(rows.tobytes())
+        self.rows += len(rows)
+        self.F.flush()
+
+    def flush(self):
+        if self.count:
+            self.F.write(self.buffer[:self.count].tobytes())
+            self.rows += self.count
+            self.count = 0
+        self.F.flush()
+        self.lastFlush = time.time()
+
+    def close(self):
+        if not self.F.closed:
+            self.flush()
+            self.F.close()
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def readHeader(fileName):
+    """ Read the header of a binary log
+
+        Input:
+
+          fileName: Path to a file written by DataLogger
+
+        Output: (header dict, record dtype, byte offset of the first record)
+    """
+    with open(fileName, 'rb') as F:
+        if F.read(len(MAGIC)) != MAGIC:
+            raise ValueError(fileName + ' is not a deposition log')
+        size = struct.unpack('<I', F.read(4))[0]
+        header = json.loads(F.read(size).decode())
+    dtype = np.dtype([tuple(d) for d in header['dtype']])
+    return header, dtype, len(MAGIC) + 4 + size
+
+
+def loadLog(fileName):
+    """ Load every complete record of a binary log into a structured array
+    """
+    header, dtype, offset = readHeader(fileName)
+    with open(fileName, 'rb') as F:
+        F.seek(0, 2)
+        count = (F.tell() - offset)//dtype.itemsize
+    return np.fromfile(fileName, dtype=dtype, count=count, offset=offset)
@@ -0,0 +1,175 @@
+"""
+Saved logs without reading them into memory: openLog memory maps a log,
+LogPyramid decimates it for plotting.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import os
+import threading
+
+from dataLogger import readHeader
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def openLog(fileName):
+    """ Memory map the complete records of a binary log, nothing is read
+        until the returned array is indexed
+
+        Input:
+
+          fileName: Path to a file written by DataLogger
+
+        Output: Read only structured np.memmap
+    """
+    header, dtype, offset = readHeader(fileName)
+    count = (os.path.getsize(fileName) - offset)//dtype.itemsize
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(fileName, dtype=dtype, mode='r', offset=offset,
+                     shape=(count,))
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class LogPyramid:
+    """ Min/max decimation pyramid over one column of a saved log.
+
+        Level k holds the first time, minimum and maximum of each block of
+        factor**k raw samples.  window picks the coarsest level that still
+        gives enough points for the requested range, so drawing costs the
+        same however long the log is.  The levels are saved next to the log
+        (fileName + '.pyr.npz') and only rebuilt when the log has grown.
+        When that directory is read only they are kept in memory only.
+
+        Building reads the whole log, about a second per GB.  With
+        background set it runs on its own thread and window returns every
+        n-th raw sample until it is done, then onReady(pyramid) is called
+        from that thread.
+    """
+    def __init__(self, data, column='piam', factor=8, fileName=None,
+                 chunk=2**20, minSize=1024, background=False, onReady=None):
+        self.data = data
+        self.column = column
+        self.factor = factor
+        self.levels = []  # (time, min, max) arrays, level 1 upwards
+        self.ready = False
+        self.onReady = onReady
+
+        cache = None if fileName is None else fileName + '.pyr.npz'
+        if cache is not None and os.path.exists(cache) and self.load(cache):
+            self.ready = True
+            return
+        if background:
+            threading.Thread(target=self._build, name='LogPyramid',
+                             args=(cache, chunk, minSize), daemon=True
+                             ).start()
+        else:
+            self._build(cache, chunk, minSize)
+
+    def _build(self, cache, chunk, minSize):
+        try:
+            self.build(chunk, minSize)
+        except Exception as e:
+            print('Building the pyramid failed: ' + repr(e))
+            return
+        self.ready = True
+        if cache is not None:
+            arrays = {'rows': len(self.data), 'column': self.column,
+                      'factor': self.factor, 'nlevels': len(self.levels)}
+            for k, (t, lo, hi) in enumerate(self.levels):
+                arrays['t' + str(k)] = t
+                arrays['lo' + str(k)] = lo
+                arrays['hi' + str(k)] = hi
+            try:
+                np.savez(cache, **arrays)
+            except OSError as e:
+                print('Pyramid of ' + cache + ' not saved: ' + str(e))
+        if self.onReady is not None:
+            self.onReady(self)
+
+    def load(self, cache):
+        """ Levels from a saved pyramid, False when it is unreadable or does
+            not match the log """
+        try:
+            saved = np.load(cache)
+            if (int(saved['rows']) != len(self.data) or
+                    str(saved['column']) != self.column or
+                    int(saved['factor']) != self.factor):
+                return False
+            levels = [(saved['t' + str(k)], saved['lo' + str(k)],
+                       saved['hi' + str(k)])
+                      for k in range(int(saved['nlevels']))]
+        except (OSError, ValueError, KeyError) as e:
+            print('Ignoring ' + cache + ': ' + str(e))
+            return False
+        self.levels = levels
+        return True
+
+    def build(self, chunk, minSize):
+        """ Compute the levels, self.levels is only set once all are done """
+        f = self.factor
+        chunk -= chunk % f
+        n = len(self.data)
+        if n <= minSize:
+            return
+
+        #  First level straight from the memory map, a chunk at a time
+        t, lo, hi = [], [], []
+        for i in range(0, n, chunk):
+            block = self.data[i:i + chunk]
+            x, y = block['time'], block[self.column]
+            t.append(x[::f])
+            lo.append(np.minimum.reduceat(y, np.arange(0, len(y), f)))
+            hi.append(np.maximum.reduceat(y, np.arange(0, len(y), f)))
+        level = (np.concatenate(t), np.concatenate(lo), np.concatenate(hi))
+        levels = [level]
+
+        #  Coarser levels from the previous one, these fit in memory
+        while len(level[0]) > minSize:
+            t, lo, hi = level
+            idx = np.arange(0, len(t), f)
+            level = (t[::f], np.minimum.reduceat(lo, idx),
+                     np.maximum.reduceat(hi, idx))
+            levels.append(level)
+        self.levels = levels
+
+    def window(self, x0, x1, maxPoints=4000):
+        """ Points to draw for the time range x0 to x1
+
+            Input:
+
+                   x0, x1: Visible time range
+
+                maxPoints: Roughly the number of points wanted, e.g. twice
+                           the plot width in pixels
+
+            Output: (x, y) arrays
+        """
+        x = self.data['time']
+        i0 = max(np.searchsorted(x, x0) - 1, 0)
+        i1 = min(np.searchsorted(x, x1) + 1, len(x))
+        if i1 - i0 <= maxPoints:
+            return (np.array(x[i0:i1]),
+                    np.array(self.data[self.column][i0:i1]))
+        if not self.levels:
+            #  Still building, or too short for a pyramid: every n-th sample
+            n = -(-(i1 - i0)//maxPoints)
+            return (np.array(x[i0:i1:n]),
+                    np.array(self.data[self.column][i0:i1:n]))
+
+        #  Coarsest level with at least maxPoints/2 blocks in the range
+        k = 0
+        while (k + 1 < len(self.levels) and
+               (i1 - i0)//self.factor**(k + 2) >= maxPoints//2):
+            k += 1
+        t, lo, hi = self.levels[k]
+        j0 = max(np.searchsorted(t, x0) - 1, 0)
+        j1 = min(np.searchsorted(t, x1) + 1, len(t))
+        y = np.empty(2*(j1 - j0))
+        y[0::2] = lo[j0:j1]
+        y[1::2] = hi[j0:j1]
+        return np.repeat(t[j0:j1], 2), y
@@ -0,0 +1,298 @@
+"""
+Runs measurements without the GUI, for unattended and scripted runs.  Every
+sample is written to a binary log (see dataLogger.py), e.g.
+
+    python headlessRun.py timeseries --points 1000 --log night.dlog
+    python headlessRun.py wave-sweep 325 700 25 --log wave.dlog
+    python headlessRun.py volt-sweep 0 100 10 --set-wave 400 --log volt.dlog
+    python headlessRun.py grid --wave 325 700 25 --volt 0 100 10 \\
+        --log grid.dlog
+    python headlessRun.py recipe qe_map.json --dry-run
+    python headlessRun.py timeseries --log night.dlog --stream 0.0.0.0:5800
+
+Only the instruments a run needs are connected.  Ctrl-C stops the run, the
+samples taken so far stay in the log.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import argparse
+import os
+import sys
+import time
+
+from picoAmmUtility import controlPA
+from monoChromUtility import controlMC
+from ringBuffer import sampleRows
+from dataLogger import DataLogger
+from sweepEngine import (PipelinedSweep, sweepPoints, waveMover, voltMover,
+                         gridPoints, GridData)
+from autoRange import AutoRange
+import recipeUtility
+import liveStream
+from retryUtility import recoverable
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class Runner:
+    """ Takes measurements and logs them the way the GUI does, without Qt.
+
+        Input:
+
+            pico: controlPA
+
+            mono: controlMC, None when the wavelength is not changed
+
+          logger: DataLogger, None to only print the results
+
+            bulk: Log every buffered reading, not only the mean
+
+          target: Relative standard error for adaptive sampling
+
+       autorange: Pick the current range per point, see autoRange.py
+
+       publisher: liveStream.Publisher the samples are also sent to, None
+                  for none
+    """
+    def __init__(self, pico, mono=None, logger=None, bulk=False, target=None,
+                 autorange=False, settle=0.1, publisher=None):
+        self.pico = pico
+        self.mono = mono
+        self.logger = logger
+        self.publisher = publisher
+        self.bulk = bulk
+        self.target = target
+        self.autorange = AutoRange() if autorange else None
+        self.settle = settle
+        self.wave = 0.
+        self.volt = 0.
+        self.count = 0  # Points measured
+
+    def record(self, new_time, result):
+        """ Log the samples of one acquisition, returns the (mean) sample """
+        sample, rows = sampleRows(new_time, result, self.volt, self.wave,
+                                  self.pico.range or 0., self.bulk)
+        if self.logger is not None:
+            for row in rows:
+                self.logger.append(row)
+        if self.publisher is not None:
+            self.publisher.publish(0, rows)
+        self.count += 1
+        print('{:6d}  {:10.3f} nm  {:8.3f} V  {:+.6e} A'.format(
+            self.count, self.wave, self.volt, sample[1]))
+        return sample
+
+    def measure(self):
+        """ One time series point at the current settings """
+        new_time = time.time()
+        if self.target:
+            measure = lambda: self.pico.aquireAdaptive(self.target)
+        elif self.bulk:
+            measure = self.pico.aquireBuffer
+        else:
+            measure = self.pico.aquireData
+        if self.autorange is not None:
+            key = (('volt', self.volt), ('wave', self.wave))
+            result = self.autorange.acquire(self.pico, key, measure)
+        else:
+            result = measure()
+        return self.record(new_time, result)
+
+    def timeseries(self, points=None, interval=0.5, duration=None):
+        """ Measure every interval seconds until points were taken or
+            duration seconds have passed, None for no limit """
+        end = None if duration is None else time.time() + duration
+        done = 0
+        while points is None or done < points:
+            start = time.time()
+            if end is not None and start >= end:
+                break
+            try:
+                self.measure()
+            except Exception as e:
+                #  A long run carries on past bus errors the retries did not
+                #  fix and buffers that did not fill, the point is skipped
+                if not recoverable(e):
+                    raise
+                print('Point skipped: ' + repr(e))
+                time.sleep(1)
+            done += 1
+            time.sleep(max(start + interval - time.time(), 0))
+
+    def sweep(self, points, COUN=20, POIN=20):
+        """ Run a list of points through PipelinedSweep, returns its results
+        """
+        movers = {'volt': voltMover(self.pico)}
+        if self.mono is not None:
+            movers['wave'] = waveMover(self.mono)
+        engine = PipelinedSweep(points, movers, self.pico, self.sweepRecord,
+                                settle=self.settle, bulk=self.bulk,
+                                target=self.target, autorange=self.autorange,
+                                COUN=100 if self.target else COUN,
+                                POIN=100 if self.target else POIN)
+        return engine.run()
+
+    def runPlan(self, plan):
+        """ Run a compiled recipe, see recipeUtility.py """
+        return recipeUtility.planSweep(plan, self.pico, self.mono,
+                                       self.sweepRecord).run()
+
+    def sweepRecord(self, point, new_time, result):
+        self.wave = float(point.get('wave', self.wave))
+        self.volt = float(point.get('volt', self.volt))
+        return self.record(new_time, result)
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def connect(args, mono=False):
+    """ Connect the picoammeter, and the monochromator when mono is set """
+    pico = controlPA(address=args.address, backend=args.backend,
+                     mode=args.mode)
+    if not pico.connectStatus:
+        raise SystemExit('Picoammeter not found at ' + args.address)
+    if not mono:
+        return pico, None
+    mc = controlMC(backend=args.backend)
+    if mc.connectStatus <= 0:
+        raise SystemExit('Monochromator not found')
+    return pico, mc
+
+
+def setup(runner, args):
+    """ Fixed wavelength, voltage and range before the run """
+    if args.wave_set is not None and runner.mono is not None:
+        runner.mono.goWave(args.wave_set)
+        runner.wave = float(args.wave_set)
+    if args.volt_set is not None:
+        runner.pico.setVoltage(args.volt_set)
+        runner.volt = float(args.volt_set)
+    if args.range is not None and runner.autorange is None:
+        runner.pico.setRange(args.range)
+
+
+def run(args):
+    plan = None
+    if args.command == 'recipe':
+        try:
+            plan = recipeUtility.compilePlan(recipeUtility.load(args.file))
+        except recipeUtility.RecipeError as e:
+            raise SystemExit('Invalid recipe ' + args.file + ':\n' + str(e))
+        print(plan.name + ': ' + recipeUtility.describe(plan))
+        if args.dry_run:
+            return 0
+        args.log = args.log or plan.log
+    needMono = args.command in ('wave-sweep', 'grid') or (
+        args.wave_set is not None) or (plan is not None and any(
+            key != 'volt' for point in plan.points + (plan.finish,)
+            for key, val in point))
+    pico, mono = connect(args, needMono)
+    logger = DataLogger(args.log) if args.log else None
+    publisher = None
+    if args.stream:
+        publisher = liveStream.Publisher(*liveStream.address(args.stream),
+                                         channels=[args.address])
+    runner = Runner(pico, mono, logger, bulk=args.bulk, target=args.target,
+                    autorange=args.autorange, settle=args.settle,
+                    publisher=publisher)
+    try:
+        setup(runner, args)
+        if args.command == 'timeseries':
+            runner.timeseries(args.points, args.interval, args.duration)
+        elif args.command == 'wave-sweep':
+            runner.sweep([{'wave': w} for w in sweepPoints(*args.limits)])
+        elif args.command == 'volt-sweep':
+            runner.sweep([{'volt': v} for v in sweepPoints(*args.limits)])
+        elif args.command == 'grid':
+            waves = sweepPoints(*args.wave)
+            volts = sweepPoints(*args.volt)
+            results = runner.sweep(gridPoints(waves, volts))
+            grid = GridData(waves, volts)
+            grid.addResults(results)
+            if args.log:
+                grid.save(os.path.splitext(args.log)[0] + '_grid.npz')
+        elif args.command == 'recipe':
+            runner.runPlan(plan)
+    except KeyboardInterrupt:
+        print('Stopped after ' + str(runner.count) + ' points')
+    finally:
+        pico.disarm()
+        pico.close()
+        if logger is not None:
+            logger.close()
+        if publisher is not None:
+            publisher.close()
+    return runner.count
+
+
+def parser():
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--log', help='binary log file for the samples')
+    common.add_argument('--backend',
+                        default=os.environ.get('DEPGUI_BACKEND', ''),
+                        help="pyvisa backend, 'sim' for the simulated "
+                        'instruments (default $DEPGUI_BACKEND)')
+    common.add_argument('--address', default='GPIB0::22::INSTR',
+                        help='picoammeter VISA address')
+    common.add_argument('--mode', default='poll',
+                        help='controlPA acquisition mode (default poll)')
+    common.add_argument('--bulk', action='store_true',
+                        help='log every buffered reading, not only the mean')
+    common.add_argument('--target', type=float,
+                        help='relative standard error for adaptive sampling,'
+                        ' e.g. 0.001')
+    common.add_argument('--autorange', action='store_true',
+                        help='pick the current range per point')
+    common.add_argument('--range', help="fixed current range, e.g. '2E-9'")
+    common.add_argument('--set-wave', dest='wave_set', type=float,
+                        help='wavelength in nm before the run')
+    common.add_argument('--set-volt', dest='volt_set', type=float,
+                        help='source voltage before the run')
+    common.add_argument('--stream', metavar='HOST:PORT',
+                        help='serve the samples to remote viewers, see '
+                        'liveStream.py')
+    common.add_argument('--settle', type=float, default=0.1,
+                        help='sweep settling time in seconds (default 0.1)')
+
+    out = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                  formatter_class=argparse.RawTextHelpFormatter)
+    commands = out.add_subparsers(dest='command')
+    commands.required = True
+    series = commands.add_parser('timeseries', parents=[common],
+                                 help='measure at fixed settings')
+    series.add_argument('--points', type=int,
+                        help='number of points (default no limit)')
+    series.add_argument('--duration', type=float,
+                        help='seconds to run (default no limit)')
+    series.add_argument('--interval', type=float, default=0.5,
+                        help='seconds between points (default 0.5)')
+    for name, unit in (('wave-sweep', 'nm'), ('volt-sweep', 'V')):
+        sweep = commands.add_parser(name, parents=[common],
+                                    help='sweep from START to STOP [' +
+                                    unit + ']')
+        sweep.add_argument('limits', type=int, nargs=3,
+                           metavar=('START', 'STOP', 'STEP'))
+    grid = commands.add_parser('grid', parents=[common],
+                               help='wavelength x voltage grid, also saved '
+                               'as <log>_grid.npz')
+    grid.add_argument('--wave', type=int, nargs=3, required=True,
+                      metavar=('START', 'STOP', 'STEP'))
+    grid.add_argument('--volt', type=int, nargs=3, required=True,
+                      metavar=('START', 'STOP', 'STEP'))
+    recipe = commands.add_parser('recipe', parents=[common],
+                                 help='run a recipe file, see '
+                                 'recipeUtility.py')
+    recipe.add_argument('file', help='JSON or YAML recipe')
+    recipe.add_argument('--dry-run', action='store_true',
+                        help='only check the recipe and estimate its '
+                        'duration')
+    return out
+
+# ----------------------------------------------------------------------------
+# Run here if main file
+# ----------------------------------------------------------------------------
+if __name__ == '__main__':
+    run(parser().parse_args())
+    sys.exit(0)
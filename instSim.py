@@ -0,0 +1,297 @@
+"""
+Simulated Keithley 6487 and Oriel Cornerstone 260 for running and testing
+without the instruments, selected with backend='sim'.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import json
+import os
+import struct
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# Configuration
+#
+# Simulated instruments are selected with backend='sim' in controlPA and
+# controlMC.  Their behaviour is set by the dictionary below, which can be
+# overridden from a JSON file named by the DEPGUI_SIM_CONFIG environment
+# variable or with loadConfig.
+# ----------------------------------------------------------------------------
+config = {
+    'addresses': ['GPIB0::22::INSTR'],  # Resources reported by list_resources
+    'latency': 0.002,       # Seconds per GPIB write or query
+    'readTime': 1/60.,      # Seconds per 6487 reading (1 PLC at 60 Hz)
+    'current': 1e-9,        # Photocurrent at the peak wavelength [Amps]
+    'noise': 0.01,          # Relative standard deviation of each reading
+    'failRate': 0.0,        # Probability that a GPIB call times out
+    'odevLatency': 0.001,   # Seconds per ODevice call
+    'waveSpeed': 200.,      # Grating speed [nm/s]
+    'odevFailRate': 0.0,    # Probability that an ODevice write fails
+    'seed': None,           # Random seed, None for a different run each time
+}
+
+#  Shared by the simulated instruments so the picoammeter sees the light
+#  selected by the simulated monochromator
+state = {'wave': 500., 'shutter': True}
+
+
+def loadConfig(fileName):
+    """ Update config from a JSON file """
+    with open(fileName) as F:
+        config.update(json.load(F))
+
+
+if os.environ.get('DEPGUI_SIM_CONFIG'):
+    loadConfig(os.environ['DEPGUI_SIM_CONFIG'])
+
+
+def timeoutError():
+    """ The exception a real VISA session raises on a timeout """
+    try:
+        from pyvisa.errors import VisaIOError
+        return VisaIOError(-1073807339)  # VI_ERROR_TMO
+    except ImportError:
+        return IOError('VI_ERROR_TMO: Timeout expired before operation '
+                       'completed.')
+
+
+def photocurrent(wave, volt, shutter=True):
+    """ Made up photocathode response, peaked at 400 nm and rising slowly with
+        the bias voltage """
+    if not shutter:
+        return 1e-3*config['current']
+    response = np.exp(-((wave - 400.)/150.)**2)
+    return config['current']*response*(1 + abs(volt)/100.)
+
+# ----------------------------------------------------------------------------
+# Keithley 6487
+# ----------------------------------------------------------------------------
+class SimResourceManager:
+    """ Stands in for pyvisa.ResourceManager """
+
+    def __init__(self, **options):
+        self.options = dict(config)
+        self.options.update(options)
+
+    def list_resources(self):
+        return tuple(self.options['addresses'])
+
+    def open_resource(self, address):
+        if address not in self.options['addresses']:
+            raise timeoutError()
+        return SimKeithley6487(address, self.options)
+
+
+class SimKeithley6487:
+    """ Enough of a Keithley 6487 session for controlPA: settings are stored,
+        INIT fills the trace buffer at readTime per reading and the usual
+        queries answer from that state.
+    """
+    def __init__(self, address, options):
+        self.resource_name = address
+        self.options = options
+        self.timeout = 2000  # ms, as in pyvisa
+        self.random = np.random.RandomState(options['seed'])
+        self.lock = threading.Lock()
+        self.closed = False
+        self.reset()
+
+    def reset(self):
+        self.settings = {'CURR:RANG': '2E-2', 'SOUR:VOLT': '0',
+                         'SOUR:VOLT:RANG': '10', 'TRIG:COUN': '1',
+                         'TRAC:POIN': '100', 'FORM:ELEM': 'READ,TIME,STAT',
+                         'FORM:DATA': 'ASC', 'FORM:BORD': 'NORM',
+                         'CALC3:FORM': 'MEAN'}
+        self.buffer = np.zeros((0, 2))
+        self.initTime = None
+        self.armed = False
+
+    # Bus ------------------------------------------------------------------
+    def _io(self):
+        if self.closed:
+            raise timeoutError()
+        time.sleep(self.options['latency'])
+        if self.random.rand() < self.options['failRate']:
+            raise timeoutError()
+
+    def write(self, message):
+        with self.lock:
+            self._io()
+            for command in message.split(';'):
+                self._command(command.strip())
+        return len(message)
+
+    def query(self, message):
+        with self.lock:
+            self._io()
+            return self._query(message.strip())
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False,
+                            container=list):
+        with self.lock:
+            self._io()
+            values = self._values(message.strip())
+        order = '>' if is_big_endian else '<'
+        raw = struct.pack(order + str(len(values)) + datatype, *values)
+        values = struct.unpack(order + str(len(values)) + datatype, raw)
+        return container(values)
+
+    def wait_for_srq(self, timeout=25000):
+        self._waitDone(timeout)
+
+    def close(self):
+        self.closed = True
+
+    # Model ----------------------------------------------------------------
+    def _command(self, command):
+        if not command:
+            return
+        header, _, value = command.partition(' ')
+        header = header.upper()
+        if header == '*RST':
+            self.reset()
+        elif header == 'INIT':
+            self.initTime = time.time()
+            self.buffer = self._readings()
+        elif header == 'TRAC:CLE':
+            self.buffer = np.zeros((0, 2))
+            self.initTime = None
+        elif header == 'TRAC:FEED:CONT':
+            self.armed = value.upper().startswith('NEXT')
+        else:
+            self.settings[header] = value
+
+    def _readings(self):
+        """ Readings the trigger model will take, with time stamps """
+        count = int(float(self.settings['TRIG:COUN']))
+        if self.armed:
+            count = min(count, int(float(self.settings['TRAC:POIN'])))
+        rang = float(self.settings['CURR:RANG'])
+        volt = float(self.settings['SOUR:VOLT'])
+        level = photocurrent(state['wave'], volt, state['shutter'])
+        read = level*(1 + self.options['noise']*self.random.randn(count))
+        read[np.abs(read) > 1.05*rang] = 9.9e37  # Overflow
+        stamp = self.options['readTime']*np.arange(1, count + 1)
+        return np.column_stack([read, stamp])
+
+    def _stored(self):
+        """ Number of readings in the buffer so far """
+        if self.initTime is None:
+            return 0
+        done = int((time.time() - self.initTime)/self.options['readTime'])
+        return min(done, len(self.buffer))
+
+    def _waitDone(self, timeout):
+        if self.initTime is None:
+            return
+        wait = len(self.buffer)*self.options['readTime']
+        wait -= time.time() - self.initTime
+        if wait > timeout/1000.:
+            time.sleep(timeout/1000.)
+            raise timeoutError()
+        time.sleep(max(wait, 0))
+
+    def _query(self, message):
+        header = message.upper()
+        if header == '*IDN?':
+            return 'KEITHLEY INSTRUMENTS INC.,MODEL 6487,0000000,SIMULATED'
+        if header == '*OPC?':
+            self._waitDone(self.timeout)
+            return '1'
+        if header == 'STAT:MEAS?':
+            return '512' if self._stored() == len(self.buffer) else '0'
+        if header == 'TRAC:POIN:ACT?':
+            return str(self._stored())
+        if header == 'CALC3:DATA?':
+            read = self.buffer[:self._stored(), 0]
+            return '%+.6E' % (read.mean() if len(read) else 0)
+        if header == 'TRAC:DATA?':
+            return ','.join('%+.6E' % v for v in self._values(header))
+        if header.endswith('?') and header[:-1] in self.settings:
+            return self.settings[header[:-1]]
+        raise timeoutError()  # Unknown query, a real 6487 would not answer
+
+    def _values(self, message):
+        if message.upper() != 'TRAC:DATA?':
+            raise timeoutError()
+        data = self.buffer[:self._stored()]
+        if 'TIME' not in self.settings['FORM:ELEM'].upper():
+            data = data[:, :1]
+        return [float(v) for v in data.ravel()]
+
+# ----------------------------------------------------------------------------
+# Oriel Cornerstone 260 through ODevice.dll
+# ----------------------------------------------------------------------------
+class SimODevice:
+    """ Stands in for the ctypes handle of ODevice.dll.  Messages are passed
+        as ctypes string buffers like the real library expects. """
+
+    def __init__(self, **options):
+        self.options = dict(config)
+        self.options.update(options)
+        self.random = np.random.RandomState(self.options['seed'])
+        self.opened = False
+        self.start = state['wave']  # Grating position when the move began
+        self.target = state['wave']
+        self.moveTime = time.time()
+        self.response = b''
+
+    def _io(self):
+        time.sleep(self.options['odevLatency'])
+
+    def position(self):
+        """ Current grating position, moving at waveSpeed towards target """
+        travel = (time.time() - self.moveTime)*self.options['waveSpeed']
+        if travel >= abs(self.target - self.start):
+            wave = self.target
+        else:
+            wave = self.start + np.sign(self.target - self.start)*travel
+        state['wave'] = wave
+        return wave
+
+    def odev_open(self):
+        self._io()
+        self.opened = True
+        return 1
+
+    def odev_close(self):
+        self.opened = False
+        return 0
+
+    def odev_write(self, message):
+        self._io()
+        if (not self.opened or
+                self.random.rand() < self.options['odevFailRate']):
+            return -1
+        text = bytes(getattr(message, 'value', message)).decode().strip()
+        command, _, value = text.partition(' ')
+        command = command.upper()
+        if command == 'GOWAVE':
+            self.start = self.position()
+            self.target = float(value)
+            self.moveTime = time.time()
+        elif command == 'SHUTTER':
+            state['shutter'] = value.upper().startswith('O')
+        elif command == 'WAVE?':
+            self.response = ('%.3f' % self.position()).encode()
+        elif command == 'SHUTTER?':
+            self.response = b'O' if state['shutter'] else b'C'
+        elif command.endswith('?'):
+            self.response = b''
+        return 0
+
+    def odev_read(self, buffer, length):
+        self._io()
+        if not self.opened:
+            return -1
+        data = self.response[:length - 1]
+        self.response = b''
+        try:
+            buffer.value = data
+        except AttributeError:
+            buffer[:len(data)] = data
+        return len(data)
@@ -0,0 +1,315 @@
+"""
+Live samples over TCP, so a run can be watched from another computer
+without a remote desktop session on the acquisition PC.  The GUI publishes
+when DEPGUI_STREAM is set to host:port (e.g. 0.0.0.0:5800 for every
+interface, the default 127.0.0.1 only serves this computer), headlessRun.py
+with --stream.  Watch with
+
+    python liveStream.py 192.168.1.20:5800          # print the samples
+    python liveStream.py 192.168.1.20:5800 --plot   # live current plot
+
+Any number of viewers may connect at any time.  Each first receives the
+last backlog samples of every channel, then the new ones as they are
+published.  A viewer that falls behind is dropped rather than slowing down
+the acquisition.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import argparse
+import json
+import queue
+import socket
+import struct
+import threading
+
+from ringBuffer import RingBuffer, sampleDtype
+from dataLogger import sampleUnits
+
+# ----------------------------------------------------------------------------
+# Framing
+#
+#   4 bytes   magic, b'DGLS'
+#   1 byte    kind, HELLO or SAMPLES
+#   2 bytes   little endian uint16, channel (station index)
+#   4 bytes   little endian uint32, length of the payload
+#   N bytes   payload
+#
+# The HELLO frame is sent once to every viewer: a JSON object with the
+# channel names, columns, units and dtype.  SAMPLES frames carry packed
+# little endian sampleDtype rows, 48 bytes each.
+# ----------------------------------------------------------------------------
+MAGIC = b'DGLS'
+HELLO = 1
+SAMPLES = 2
+
+frameHeader = struct.Struct('<4sBHI')
+wireDtype = sampleDtype.newbyteorder('<')
+
+defaultPort = 5800
+
+
+def frame(kind, channel, payload):
+    return frameHeader.pack(MAGIC, kind, channel, len(payload)) + payload
+
+
+def address(text, host='127.0.0.1'):
+    """ (host, port) from 'host:port', 'port' or 'host' """
+    name, _, port = text.rpartition(':')
+    if not name and not port.isdigit():
+        name, port = port, ''
+    return name or host, int(port) if port else defaultPort
+
+
+def recvExact(sock, size):
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise EOFError('Stream closed')
+        data += chunk
+    return data
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class Publisher:
+    """ TCP server streaming samples to every connected viewer.
+
+        Input:
+
+              host: Interface to listen on, '0.0.0.0' for all
+
+              port: TCP port, 0 picks a free one (see self.port)
+
+          channels: Channel names, e.g. the station names
+
+           backlog: Samples per channel kept for viewers that join late
+
+         queueSize: Frames a viewer may lag behind before it is dropped
+
+        publish may be called from any thread, sending happens on one
+        thread per viewer.
+    """
+    def __init__(self, host='127.0.0.1', port=defaultPort,
+                 channels=('Station 1',), backlog=10000, queueSize=1000):
+        self.channels = list(channels)
+        self.queueSize = queueSize
+        self.history = [RingBuffer(backlog, dtype=wireDtype)
+                        for name in self.channels]
+        self.viewers = {}  # Queue of frames: socket, one per viewer
+        self.lock = threading.Lock()
+        self.hello = frame(HELLO, 0, json.dumps({
+            'channels': self.channels, 'columns': list(wireDtype.names),
+            'units': sampleUnits, 'dtype': wireDtype.descr}).encode())
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(5)
+        self.port = self.server.getsockname()[1]
+        self.alive = True
+        threading.Thread(target=self._accept, name='liveStream',
+                         daemon=True).start()
+
+    def publish(self, channel, rows):
+        """ Send samples of one channel, rows are sampleDtype tuples or an
+            array """
+        rows = np.asarray(rows, dtype=wireDtype)
+        if len(rows) == 0:
+            return
+        data = frame(SAMPLES, channel, rows.tobytes())
+        with self.lock:
+            self.history[channel].extend(rows)
+            for viewer in list(self.viewers):
+                try:
+                    viewer.put_nowait(data)
+                except queue.Full:
+                    self._drop(viewer)
+
+    def close(self):
+        self.alive = False
+        self.server.close()
+        with self.lock:
+            for viewer in list(self.viewers):
+                self._drop(viewer)
+
+    def _drop(self, viewer):
+        """ Stop sending to a viewer, with self.lock held.  Shutting the
+            socket down also wakes a sender stuck on a viewer that stopped
+            reading. """
+        sock = self.viewers.pop(viewer, None)
+        if sock is None:
+            return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        while True:
+            try:
+                viewer.get_nowait()
+            except queue.Empty:
+                break
+        viewer.put_nowait(None)
+
+    def _accept(self):
+        while self.alive:
+            try:
+                sock, peer = self.server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            viewer = queue.Queue(self.queueSize)
+            # The backlog and registering the viewer under one lock, so no
+            # sample is missed or sent twice
+            with self.lock:
+                frames = [self.hello]
+                for channel, history in enumerate(self.history):
+                    if len(history):
+                        frames.append(frame(SAMPLES, channel,
+                                            history.view().tobytes()))
+                self.viewers[viewer] = sock
+            threading.Thread(target=self._send, args=(sock, viewer, frames),
+                             name='liveStream ' + str(peer), daemon=True
+                             ).start()
+
+    def _send(self, sock, viewer, frames):
+        try:
+            for data in frames:
+                sock.sendall(data)
+            while True:
+                data = viewer.get()
+                if data is None:
+                    break
+                sock.sendall(data)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.viewers.pop(viewer, None)
+            sock.close()
+
+
+class Subscriber:
+    """ Client of a Publisher.  self.channels, self.units are set from its
+        HELLO frame, read returns (channel, rows) with rows a sampleDtype
+        array """
+
+    def __init__(self, host='127.0.0.1', port=defaultPort, timeout=10.):
+        self.sock = socket.create_connection((host, port), timeout)
+        kind, channel, payload = self._frame()
+        if kind != HELLO:
+            raise IOError('Not a liveStream server')
+        hello = json.loads(payload.decode())
+        self.channels = hello['channels']
+        self.units = hello['units']
+        self.dtype = np.dtype([tuple(field) for field in hello['dtype']])
+        self.sock.settimeout(None)
+
+    def _frame(self):
+        magic, kind, channel, size = frameHeader.unpack(
+            recvExact(self.sock, frameHeader.size))
+        if magic != MAGIC:
+            raise IOError('Bad frame from liveStream server')
+        return kind, channel, recvExact(self.sock, size)
+
+    def read(self):
+        """ Next (channel, rows), raises EOFError once the server is gone """
+        while True:
+            kind, channel, payload = self._frame()
+            if kind == SAMPLES:
+                return channel, np.frombuffer(payload, dtype=self.dtype)
+
+    def close(self):
+        self.sock.close()
+
+# ----------------------------------------------------------------------------
+# Viewers
+# ----------------------------------------------------------------------------
+def printSamples(sub):
+    while True:
+        channel, rows = sub.read()
+        for row in rows:
+            print('{:<12s} {:.3f}  {:10.3f} nm  {:8.3f} V  {:+.6e} A'.format(
+                sub.channels[channel], row['time'], row['wave'], row['volt'],
+                row['piam']))
+
+
+def plotSamples(sub, history=int(1e6)):
+    """ Live current plot of every channel, pyqtgraph is only needed here
+    """
+    from PyQt5 import QtWidgets, QtCore
+    import pyqtgraph as pg
+    from ringBuffer import PeakDecimator
+
+    app = QtWidgets.QApplication([])
+    graph = pg.PlotWidget()
+    graph.setBackground('w')
+    graph.showGrid(x=True, y=True)
+    graph.setLabel('bottom', 'Time [Seconds]')
+    graph.setLabel('left', 'Current [Amps]')
+    graph.setWindowTitle('Live Current')
+    if len(sub.channels) > 1:
+        graph.addLegend()
+    data = [RingBuffer(history) for name in sub.channels]
+    peaks = [PeakDecimator(history) for name in sub.channels]
+    lines = [graph.plot([], [], name=name, pen=pg.mkPen(
+        color=pg.intColor(i, hues=len(sub.channels))))
+        for i, name in enumerate(sub.channels)]
+    received = queue.Queue()
+
+    def reader():
+        try:
+            while True:
+                received.put(sub.read())
+        except (EOFError, OSError):
+            received.put(None)
+    threading.Thread(target=reader, daemon=True).start()
+
+    def update():
+        while True:
+            try:
+                item = received.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                graph.setWindowTitle('Live Current (disconnected)')
+                continue
+            channel, rows = item
+            data[channel].extend(rows)
+            for row in rows.tolist():
+                peaks[channel].append(row)
+        width = max(graph.width(), 100)
+        for buf, peak, line in zip(data, peaks, lines):
+            line.setData(*peak.trace(buf.view(), 'piam', maxPoints=2*width))
+
+    timer = QtCore.QTimer()
+    timer.timeout.connect(update)
+    timer.start(250)
+    graph.show()
+    return app.exec_()
+
+# ----------------------------------------------------------------------------
+# Run viewer here if main file
+# ----------------------------------------------------------------------------
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0],
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('server', nargs='?', default='127.0.0.1',
+                        help='host:port of the GUI or headlessRun.py '
+                        '(default 127.0.0.1:' + str(defaultPort) + ')')
+    parser.add_argument('--plot', action='store_true',
+                        help='plot the current instead of printing samples')
+    args = parser.parse_args()
+    sub = Subscriber(*address(args.server))
+    try:
+        if args.plot:
+            plotSamples(sub)
+        else:
+            printSamples(sub)
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        sub.close()
@@ -8,9 +8,19 @@ Python Version: 3.7, 32 bit
 # -------------------------------------------------------------------------- #
 # Imports
 # -------------------------------------------------------------------------- #
-import matplotlib.pyplot as plt
 import numpy as np
+import asyncio
 import ctypes
+import os
+import threading
+import time
+
+from asyncDevice import DeviceExecutor
+from retryUtility import Retry
+
+#  Held while the ODevice library is loaded, stations may connect their
+#  monochromators from several threads at once
+dllLock = threading.Lock()
 
 # -------------------------------------------------------------------------- #
 # Class
@@ -20,17 +30,57 @@ class controlMC:
 
     def __init__(self, \
             libDict=r'C:\Users\Dep Chamber\Desktop\meas_python_scripts\DLL', \
-            libName=r'ODevice.dll'):
-        #  Imports modules needed for class functions
-        import numpy as np
-        import ctypes
-        import os
-
-        #  Import Oriel Control .dll Library
-        fd = os.getcwd()  #  File Directory
-        os.chdir(libDict)
-        self.lib = ctypes.CDLL(libName)
-        os.chdir(fd)
+            libName=r'ODevice.dll', backend='', connect=True):
+        """ Input:
+
+              libDict: Directory holding the Oriel ODevice library
+
+              libName: File name of the library
+
+              backend: '' for the real library, 'sim' for the simulated
+                       monochromator in instSim.py
+
+              connect: Connect straight away, otherwise call connect later
+                       (e.g. from a background thread)
+        """
+        self.libDict = libDict
+        self.libName = libName
+        self.backend = backend
+        self.connectStatus = 0
+        self.lib = None
+
+        #  Thread the async methods run ODevice calls on
+        self.io = DeviceExecutor('controlMC')
+
+        #  ODevice calls are retried when they fail, reopening the device in
+        #  between, see retryUtility.py.  The library has no timeouts of its
+        #  own, waitSettled bounds the moves.
+        self.retry = Retry('controlMC', recover=self.recover)
+
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """ Load the ODevice library and open the monochromator
+
+            Output: connectStatus, > 0 when connected
+        """
+        #  Import Oriel Control .dll Library.  Loaded by its full path with
+        #  libDict added to the DLL search path for the libraries it needs,
+        #  changing the working directory would affect every thread.
+        if self.backend == 'sim':
+            from instSim import SimODevice
+            self.lib = SimODevice()
+        else:
+            with dllLock:
+                if hasattr(os, 'add_dll_directory'):
+                    self.dllDirectory = os.add_dll_directory(self.libDict)
+                else:
+                    path = os.environ.get('PATH', '')
+                    if self.libDict not in path.split(os.pathsep):
+                        os.environ['PATH'] = self.libDict + os.pathsep + path
+                self.lib = ctypes.CDLL(os.path.join(self.libDict,
+                                                    self.libName))
 
         #  Open Oriel Device, defaults to first Oriel device found
         self.connectStatus = self.lib.odev_open()
@@ -40,6 +90,7 @@ class controlMC:
             print('\nConnected to Monochromator\n')
         else:
             print('\nCould not connect to Monochromator\n')
+        return self.connectStatus
 
     def write(self, message):
         """ Send Message to Oriel Cornerstone 260 Monochromator.  See MCS130
@@ -49,20 +100,131 @@ class controlMC:
 
               message: essage sent to monochromator.
 
-                 wait: Time to wait between each message
+            Output: None, raises IOError when the write still fails after
+                    the retries
+        """
+        self.checkConnected()
+        if type(message) != bytes:
+            raise TypeError('Input must be type bytes')
+        self.retry.call(self._send, message)
+
+    def read(self, size=256):
+        """ Read the reply to the last query from the monochromator
+
+            Input:
+
+              size: Size of the receive buffer in bytes
 
-            Output: None
+            Output: Reply as bytes, stripped of the line ending
         """
-        assert self.connectStatus, \
-        'ERROR, not connected to any devices'
+        self.checkConnected()
+        buffer = ctypes.create_string_buffer(size)
+        count = self.lib.odev_read(buffer, size)
+        if count < 0:
+            raise IOError('odev_read failed with ' + str(count))
+        return buffer.value.strip()
+
+    def query(self, message, size=256):
+        """ Send a query such as b'WAVE?' and return the reply as bytes """
+        self.checkConnected()
+        return self.retry.call(self._ask, message, size)
+
+    def _send(self, message):
+        code = self.lib.odev_write(ctypes.create_string_buffer(message, 256))
+        if code < 0:
+            raise IOError('odev_write failed with ' + str(code))
+
+    def _ask(self, message, size):
+        self._send(message)
+        return self.read(size)
+
+    def checkConnected(self):
+        if self.lib is None or self.connectStatus <= 0:
+            raise IOError('ERROR, not connected to any devices')
+
+    def recover(self):
+        """ Close and reopen the monochromator after a failed call """
+        self.lib.odev_close()
+        if self.lib.odev_open() <= 0:
+            raise IOError('Could not reopen the monochromator')
 
-        assert type(message) == bytes, 'Input must be type bytes'
+    def getWave(self):
+        """ Current wavelength in nm as reported by the monochromator """
+        return float(self.query(b'WAVE?'))
 
-        message = ctypes.create_string_buffer(message, 256)
+    def goWave(self, wave, wait=True, **kwargs):
+        """ Move to a wavelength, by default returning once it is reached
 
-        self.lib.odev_write(message)
+            Input:
 
-        return
+                wave: Wavelength in nm
+
+                wait: Block until waitSettled returns, kwargs are passed on
+
+            Output: Settled wavelength, or None when wait is False
+        """
+        self.write(b'GOWAVE ' + '{:g}'.format(wave).encode())
+        if wait:
+            return self.waitSettled(wave, **kwargs)
+
+    def waitSettled(self, target=None, tol=0.05, timeout=30, poll=0.01):
+        """ Poll WAVE? until the grating has stopped
+
+            Input:
+
+               target: Wavelength the grating is moving to in nm, None to
+                       only wait for two identical readings
+
+                  tol: Allowed difference from target in nm
+
+              timeout: Seconds before giving up with a TimeoutError
+
+                 poll: Seconds between WAVE? queries
+
+            Output: Settled wavelength in nm
+        """
+        end = time.time() + timeout
+        last = None
+        while True:
+            wave = self.getWave()
+            if target is None or abs(wave - float(target)) <= tol:
+                if last is not None and abs(wave - last) <= tol:
+                    return wave
+            last = wave
+            if time.time() > end:
+                raise TimeoutError('Monochromator did not settle at ' +
+                                   str(target) + ' nm, at ' + str(wave))
+            time.sleep(poll)
+
+    # asyncio variants: ODevice calls run on self.io, waits are
+    # asyncio.sleep so other coroutines run while the grating moves
+    async def writeAsync(self, message):
+        await self.io.call(self.write, message)
+
+    async def getWaveAsync(self):
+        return await self.io.call(self.getWave)
+
+    async def goWaveAsync(self, wave, wait=True, **kwargs):
+        """ As goWave, as a coroutine """
+        await self.writeAsync(b'GOWAVE ' + '{:g}'.format(wave).encode())
+        if wait:
+            return await self.waitSettledAsync(wave, **kwargs)
+
+    async def waitSettledAsync(self, target=None, tol=0.05, timeout=30,
+                               poll=0.01):
+        """ As waitSettled, as a coroutine """
+        end = time.time() + timeout
+        last = None
+        while True:
+            wave = await self.getWaveAsync()
+            if target is None or abs(wave - float(target)) <= tol:
+                if last is not None and abs(wave - last) <= tol:
+                    return wave
+            last = wave
+            if time.time() > end:
+                raise TimeoutError('Monochromator did not settle at ' +
+                                   str(target) + ' nm, at ' + str(wave))
+            await asyncio.sleep(poll)
 
     def close(self):
         """ Stop communication with monochromator
@@ -8,75 +8,451 @@ Python Version: 3.7, 32 bit
 # -------------------------------------------------------------------------- #
 # Module Imports
 # -------------------------------------------------------------------------- #
-import matplotlib.pyplot as plt
 import numpy as np
+import asyncio
+import collections
 import time
 
+from asyncDevice import DeviceExecutor
+from retryUtility import Retry, retried
+import visaPool
+
+#  Result of controlPA.aquireBuffer: every reading, its instrument time stamp
+#  in seconds and the statistics of the readings, sem is the standard error
+#  of the mean
+BufferData = collections.namedtuple('BufferData', 'read time mean std sem')
+
+#  pyvisa error code of a VISA timeout
+VI_ERROR_TMO = -1073807339
+
+
+def bufferData(read, stamp):
+    """ BufferData of the readings read taken at times stamp """
+    if len(read) > 1:
+        sem = read.std(ddof=1)/np.sqrt(len(read))
+    else:
+        sem = np.inf
+    return BufferData(read, stamp, read.mean(), read.std(), sem)
+
 # -------------------------------------------------------------------------- #
 # Class
 # -------------------------------------------------------------------------- #
 class controlPA:
     """ Used to control a Keithley 6487 picoammeter """
 
-    def __init__(self, address='GPIB0::22::INSTR'):
-        #  Imports modules needed for class functions
-        import numpy as np
-        import pyvisa
-        #  Initialize NI VISA resource manager
-        rm = pyvisa.ResourceManager()
+    def __init__(self, address='GPIB0::22::INSTR', backend='', mode='poll',
+                 connect=True):
+        """ Input:
 
-        #  Check if specified address is seen by NI VISA
-        if address in np.array(rm.list_resources()):
-            self.connectStatus = True
-        else:
-            self.connectStatus = False
+              address: VISA resource name of the picoammeter
+
+              backend: pyvisa backend, '' for NI VISA or 'sim' for the
+                       simulator in instSim.py
+
+                 mode: How aquireData waits for the buffer to fill, one of
+                       'poll' (TRAC:POIN:ACT?), 'opc' (*OPC?), 'srq' (service
+                       request on buffer full) or 'sleep' (fixed delays)
+
+              connect: Connect straight away, otherwise call connect later
+                       (e.g. from a background thread)
+        """
+        self.address = address
+        self.backend = backend
+        self.connectStatus = False
+
+        #  Acquisition settings, see aquireData
+        self.mode = mode
+        self.pollInterval = 0.01  #  Seconds between TRAC:POIN:ACT? queries
+        self.timeout = 30         #  Seconds to wait for the buffer to fill
+        self.ioTimeout = 5        #  Seconds a single write or query may take
+        self.clock = time         #  time() and sleep(), traced by cmdTrace
+
+        #  Last value sent for each SCPI setting, see setConfig
+        self.config = {}
+        self.range = None  #  Current range in Amps set by setRange
+
+        #  Thread the async methods run instrument calls on
+        self.io = DeviceExecutor('controlPA')
+
+        #  Acquisitions and settings are retried on bus errors, reopening
+        #  the session in between, see retryUtility.py
+        self.retry = Retry('controlPA', recover=self.recover)
+
+        if connect:
+            self.connect()
+
+    def connect(self):
+        """ Open the VISA session, identify and reset the picoammeter
+
+            Output: connectStatus, True when connected
+        """
+        #  Check if specified address is seen by NI VISA, the process-wide
+        #  resource manager only loads pyvisa on first use and the bus is only
+        #  scanned again when it is not in the cached list
+        self.connectStatus = (
+            self.address in visaPool.listResources(self.backend) or
+            self.address in visaPool.listResources(self.backend, True))
+        if not self.connectStatus:
             print('Could not connect, is address valid?')
 
-        #  Connect to device if address is found
+        #  Connect to device if address is found, reusing the session from
+        #  an earlier connect while it still answers
         if self.connectStatus:
-            self.inst = rm.open_resource(address)
-            print('Connected to ' + self.inst.query('*IDN?') + '\n')
+            self.inst = visaPool.openSession(self.address, self.backend)
+            try:
+                idn = self.inst.query('*IDN?')
+            except Exception:
+                self.inst = visaPool.openSession(self.address, self.backend,
+                                                 reopen=True)
+                idn = self.inst.query('*IDN?')
+            print('Connected to ' + idn + '\n')
+            self.inst.timeout = self.ioTimeout*1000
 
             #  Return Keithley 6487 to GPIB default settings
-            self.inst.write('*RST')
-
-    def aquireData(self, COUN=20, POIN=20):
-#        self.inst.write('CURR:RANGE 200E-9')  #  Set current Range
-#        time.sleep(0.05)
-        self.inst.write('CURR:RANGE:AUTO OFF')
-        time.sleep(0.05)
-        self.inst.write('TRIG:CLE')
-        time.sleep(0.05)
-        self.inst.write('FORM:ELEM READ')
-        time.sleep(0.05)
-        self.inst.write('TRIG:COUN 20')  #  Set trigger model to take 20 readings
-        time.sleep(0.05)
-        self.inst.write('TRAC:POIN 20')  #  Set buffer size to 20
-        time.sleep(0.05)
-        self.inst.write('TRAC:FEED SENS')  #  Store raw input readings
-        time.sleep(0.05)        
+            self.reset()
+        return self.connectStatus
+
+    def recover(self):
+        """ Reopen the VISA session after a bus error.  The instrument keeps
+            its settings (no *RST) but they are all sent again.
+        """
+        old = self.inst
+        self.inst = visaPool.openSession(self.address, self.backend,
+                                         reopen=True)
+        self.inst.timeout = self.ioTimeout*1000
+        from cmdTrace import TracedResource
+        if isinstance(old, TracedResource):
+            self.inst = TracedResource(self.inst, old.tracer, old.cat)
+        self.invalidateConfig()
+
+    def close(self):
+        """ Close the VISA session, connect opens a new one """
+        visaPool.closeSession(self.address, self.backend)
+        self.connectStatus = False
+
+    @retried
+    def aquireData(self, COUN=20, POIN=20, mode=None):
+        """ Take COUN readings into the trace buffer and return their mean.
+
+            Input:
+
+                COUN: Number of readings taken per trigger
+
+                POIN: Size of the trace buffer
+
+                mode: Overrides self.mode for this call
+
+            Output: Mean of the buffered readings in Amps
+        """
+        self.arm(COUN, POIN, mode, bulk=False)
+        self.measure(mode)
+        return self.readMean()
+
+    @retried
+    def aquireBuffer(self, COUN=20, POIN=20, mode=None):
+        """ Take COUN readings and read the whole trace buffer back in one
+            binary transfer.
+
+            Input:
+
+                COUN: Number of readings taken per trigger
+
+                POIN: Size of the trace buffer
+
+                mode: Overrides self.mode for this call
+
+            Output: BufferData with the readings in Amps, their time stamps
+                    in seconds from the first reading, mean and standard
+                    deviation
+        """
+        self.arm(COUN, POIN, mode, bulk=True)
+        self.measure(mode)
+        return self.readBuffer()
+
+    # The steps of an acquisition, split so a sweep can do other work (e.g.
+    # move the monochromator) between them: arm, measure, readMean or
+    # readBuffer.
+    def arm(self, COUN=20, POIN=20, mode=None, bulk=False):
+        """ Configure the trigger model and an empty trace buffer, ready for
+            measure.
+
+            Input:
+
+                COUN: Number of readings taken per trigger
+
+                POIN: Size of the trace buffer
+
+                mode: Overrides self.mode for this call
+
+                bulk: Store time stamps and return binary data for
+                      readBuffer, otherwise ASCII for readMean
+
+            Output: None
+        """
+        mode = self.mode if mode is None else mode
+        #  Fixed delays are only needed by the legacy 'sleep' mode, GPIB writes
+        #  are already complete when inst.write returns
+        delay = 0.05 if mode == 'sleep' else 0
+
+        #  Settings are only sent when they differ from the cached state
+        if bulk:
+            self.setConfig('FORM:DATA', 'SRE')   #  32 bit IEEE754 floats
+            self.setConfig('FORM:BORD', 'SWAP')  #  Little endian
+        else:
+            self.setConfig('FORM:DATA', 'ASC')
+        self.setConfig('CURR:RANGE:AUTO', 'OFF')
+        self.inst.write('TRIG:CLE')  #  Clear pending triggers, every time
+        self.clock.sleep(delay)
+        self.setConfig('FORM:ELEM', 'READ,TIME' if bulk else 'READ')
+        self.setConfig('TRIG:COUN', str(int(COUN)))  #  Readings per trigger
+        self.setConfig('TRAC:POIN', str(int(POIN)))  #  Set buffer size
+        self.setConfig('TRAC:FEED', 'SENS')  #  Store raw input readings
+        self.setConfig('CALC3:FORM', 'MEAN')
+        self.inst.write('TRAC:CLE')  #  Empty buffer so TRAC:POIN:ACT? counts up
+        self.clock.sleep(delay)
         self.inst.write('TRAC:FEED:CONT NEXT')  #  Start storing readings
-        time.sleep(0.05)        
+        self.clock.sleep(delay)
+        if mode == 'srq':
+            self.setConfig('STAT:MEAS:ENAB', '512')  #  Buffer full event
+            self.setConfig('*SRE', '1')  #  Measurement summary requests service
         self.inst.write('SYST:ZCH OFF') #  Disable zero check
-        time.sleep(0.05)
+        self.clock.sleep(delay)
+        self.points = min(COUN, POIN)  #  Readings measure waits for
+
+    def measure(self, mode=None):
+        """ Take the readings set up by arm and wait until they are stored
+        """
+        mode = self.mode if mode is None else mode
+        self.measureTime = self.clock.time()
         self.inst.write('INIT')  #  Trigger readings setup to SRQ on buffer full
-        time.sleep(6)            #  NOTE!!! You need to give device time to record
+        self.waitBufferFull(self.points, mode)
         self.inst.write('SYST:ZCH ON') #  enable zero check
-        time.sleep(0.1)
-        self.inst.write('CALC3:FORM MEAN')
-        time.sleep(0.05)
+        if mode == 'sleep':
+            self.clock.sleep(0.1)
+
+    def disarm(self):
+        """ Re-enable zero check after arm when measure will not be called """
+        self.inst.write('SYST:ZCH ON')
+
+    def readMean(self):
+        """ Mean of the buffered readings in Amps, after arm(bulk=False) """
         return float(self.inst.query('CALC3:DATA?'))
-    
+
+    def readBuffer(self):
+        """ Every buffered reading as BufferData, after arm(bulk=True) """
+        data = self.inst.query_binary_values('TRAC:DATA?', datatype='f',
+                                             is_big_endian=False,
+                                             container=np.array)
+        data = data.astype(np.float64).reshape(-1, 2)
+        read = data[:, 0]
+        stamp = data[:, 1] - data[0, 1]
+        return bufferData(read, stamp)
+
+    @retried
+    def aquireAdaptive(self, target=1e-3, COUN=100, POIN=100, block=10,
+                       mode=None):
+        """ Take blocks of readings until their relative standard error of
+            the mean reaches target, so quiet signals are measured quickly
+            and noisy ones get more readings.
+
+            Input:
+
+              target: Wanted standard error of the mean / |mean|
+
+                COUN: Maximum number of readings
+
+                POIN: Size of the trace buffer, limits the block size
+
+               block: Readings per block
+
+                mode: Overrides self.mode for this call
+
+            Output: BufferData of all readings, time stamps in seconds from
+                    the first reading
+        """
+        block = min(block, COUN, POIN)
+        self.arm(block, POIN, mode, bulk=True)
+        self.measure(mode)
+        return self.refine(self.readBuffer(), target, COUN, POIN, mode)
+
+    def refine(self, buf, target, COUN=100, POIN=100, mode=None):
+        """ Add blocks of readings to buf, the BufferData of the last
+            measure, until the relative standard error of the mean reaches
+            target or there are COUN readings.  The picoammeter must not have
+            been re-armed since buf was measured.
+
+            Output: BufferData of all readings
+        """
+        block = len(buf.read)
+        start = self.measureTime
+        reads, stamps = [buf.read], [buf.time]
+        count = block
+        while count < COUN and not buf.sem <= target*abs(buf.mean):
+            size = min(block, COUN - count)
+            self.arm(size, POIN, mode, bulk=True)
+            self.measure(mode)
+            more = self.readBuffer()
+            reads.append(more.read)
+            stamps.append(more.time + self.measureTime - start)
+            count += len(more.read)
+            buf = bufferData(np.concatenate(reads), np.concatenate(stamps))
+        return buf
+
+    # asyncio variants: instrument calls run on self.io, waits are
+    # asyncio.sleep so other coroutines run while the buffer fills
+    async def aquireAsync(self, COUN=20, POIN=20, bulk=False):
+        """ As aquireData, or aquireBuffer with bulk set, as a coroutine """
+        await self.armAsync(COUN, POIN, bulk)
+        await self.measureAsync()
+        return await self.readAsync(bulk)
+
+    async def armAsync(self, COUN=20, POIN=20, bulk=False):
+        await self.io.call(self.arm, COUN, POIN, 'poll', bulk)
+
+    async def measureAsync(self):
+        """ As measure, polling TRAC:POIN:ACT? without blocking the loop """
+        self.measureTime = self.clock.time()
+        await self.io.call(self.inst.write, 'INIT')
+        await self.waitBufferFullAsync(self.points)
+        await self.io.call(self.inst.write, 'SYST:ZCH ON')
+
+    async def readAsync(self, bulk=False):
+        if bulk:
+            return await self.io.call(self.readBuffer)
+        return await self.io.call(self.readMean)
+
+    async def waitBufferFullAsync(self, points):
+        end = self.clock.time() + self.timeout
+        query = self.inst.query
+        while int(float(await self.io.call(query, 'TRAC:POIN:ACT?'))) < points:
+            if self.clock.time() > end:
+                raise TimeoutError('Trace buffer did not fill in ' +
+                                   str(self.timeout) + ' s')
+            await asyncio.sleep(self.pollInterval)
+
+    async def setVoltageAsync(self, volt):
+        return await self.io.call(self.setVoltage, volt)
+
+    async def setRangeAsync(self, rang):
+        await self.io.call(self.setRange, rang)
+
+    def setConfig(self, header, value):
+        """ Send a SCPI setting only if it differs from the cached value.
+            Commands that act rather than set (e.g. TRIG:CLE, TRAC:CLE) are
+            written directly every time.
+
+            Input:
+
+              header: SCPI command header, e.g. 'TRIG:COUN'
+
+               value: Parameter sent after the header
+
+            Output: True if the command was written to the instrument
+        """
+        if self.config.get(header) == value:
+            return False
+        self.inst.write((header + ' ' + value).strip())
+        if self.mode == 'sleep':
+            self.clock.sleep(0.05)
+        self.config[header] = value
+        return True
+
+    def invalidateConfig(self):
+        """ Forget the cached settings, the next aquireData resends them all
+        """
+        self.config = {}
+
+    def reset(self):
+        """ Return the Keithley 6487 to GPIB default settings
+        """
+        self.inst.write('*RST')
+        self.invalidateConfig()
+        self.range = None
+
+    @retried
+    def setRange(self, rang):
+        """ Set the current range and invalidate the cached settings.
+
+            Input:
+
+              rang: Range in Amps, e.g. '2E-9'
+
+            Output: None
+        """
+        self.inst.write('CURR:RANG ' + str(rang))
+        self.invalidateConfig()
+        self.range = float(rang)
+
+    def waitBufferFull(self, points, mode=None):
+        """ Block until the trace buffer holds points readings.
+
+            Input:
+
+              points: Number of readings expected in the buffer
+
+                mode: 'poll', 'opc', 'srq' or 'sleep', see __init__
+
+            Output: None, raises TimeoutError if self.timeout is exceeded
+        """
+        mode = self.mode if mode is None else mode
+        if mode == 'sleep':
+            self.clock.sleep(6)  #  NOTE!!! You need to give device time to record
+        elif mode in ('opc', 'srq'):
+            try:
+                if mode == 'opc':
+                    #  *OPC? only answers once INIT has finished, so the VISA
+                    #  timeout has to cover the whole acquisition
+                    old = self.inst.timeout
+                    self.inst.timeout = self.timeout*1000
+                    try:
+                        self.inst.query('*OPC?')
+                    finally:
+                        self.inst.timeout = old
+                else:
+                    self.inst.wait_for_srq(self.timeout*1000)
+            except Exception as e:
+                #  The whole self.timeout has passed, not a bus glitch to
+                #  retry
+                if getattr(e, 'error_code', None) != VI_ERROR_TMO:
+                    raise
+                raise TimeoutError('Trace buffer did not fill in ' +
+                                   str(self.timeout) + ' s')
+            if mode == 'srq':
+                self.inst.query('STAT:MEAS?')  #  Reading clears the event register
+        elif mode == 'poll':
+            end = self.clock.time() + self.timeout
+            while int(float(self.inst.query('TRAC:POIN:ACT?'))) < points:
+                if self.clock.time() > end:
+                    raise TimeoutError('Trace buffer did not fill in ' +
+                                       str(self.timeout) + ' s')
+                self.clock.sleep(self.pollInterval)
+        else:
+            raise ValueError('Unknown acquisition mode: ' + str(mode))
+
+    @retried
+    def setVoltage(self, volt):
+        """ Set the voltage source, picking the source range from the value.
+
+            Input:
+
+              volt: Source voltage in Volts
+
+            Output: Voltage read back from the instrument
+        """
+        self.setConfig('SOUR:VOLT:RANG', '{:g}'.format(volt))
+        self.setConfig('SOUR:VOLT', '{:g}'.format(volt))
+        return float(self.inst.query('SOUR:VOLT?'))
+
     def voltageSweep(self, start, stop, step, delay=0.1):
         sweep1 = ['SOUR:VOLT:RANG ' + str(int(i)) for i in np.arange(start, stop+step, step)]
         sweep2 = ['SOUR:VOLT ' + str(int(i)) for i in np.arange(start, stop+step, step)]
         sweep3 = ['SOUR:VOLT?' for i in np.arange(start, stop+step, step)]
         for i in range(len(sweep1)):
-            time.sleep(1)
+            self.clock.sleep(1)
             self.inst.write(sweep1[i])
-            time.sleep(1)
+            self.clock.sleep(1)
             self.inst.write(sweep2[i])    
-            time.sleep(1)
+            self.clock.sleep(1)
             print(self.inst.query(sweep3[i]))
             print(self.aquireData())
             
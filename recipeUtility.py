@@ -0,0 +1,340 @@
+"""
+Measurement recipes: a JSON (or YAML, when PyYAML is installed) file listing
+the steps of a run, e.g.
+
+    {"name": "QE map",
+     "log": "qe.dlog",
+     "settle": 0.1,
+     "acquire": {"COUN": 20, "POIN": 20, "bulk": false, "target": null,
+                 "range": "auto"},
+     "steps": [
+        {"type": "set", "wave": 400, "volt": 0, "shutter": "open"},
+        {"type": "repeat", "points": 100, "dwell": 0.5},
+        {"type": "wave-sweep", "start": 325, "stop": 700, "step": 25},
+        {"type": "volt-sweep", "start": 0, "stop": 100, "step": 10,
+         "settle": 0.5},
+        {"type": "grid", "wave": [325, 700, 25], "volt": [0, 100, 10]},
+        {"type": "set", "shutter": "closed"}]}
+
+load reads a file, validate checks every field up front and compilePlan
+turns the recipe into a Plan: an immutable, flat list of measurement points
+with their settling times and an estimate of the run time.  planSweep makes
+the PipelinedSweep that runs a plan.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import collections
+import json
+import math
+import os
+
+from autoRange import AutoRange, currentRanges
+from sweepEngine import (PipelinedSweep, sweepPoints, gridPoints, moveTime,
+                         waveMover, voltMover)
+
+# ----------------------------------------------------------------------------
+# Limits
+# ----------------------------------------------------------------------------
+limits = {'wave': (0., 2500.),    # Cornerstone 260 grating range [nm]
+          'volt': (-500., 500.)}  # 6487 voltage source [V]
+
+readTime = 1/60.    # Seconds per 6487 reading at 1 PLC, 60 Hz
+pointTime = 0.05    # Seconds of bus traffic per measured point
+
+#  Compiled recipe.  points is a tuple of ((key, value), ...) setpoints,
+#  settle the seconds waited before measuring each of them, finish the
+#  setpoints of 'set' steps after the last measurement and duration the
+#  estimated run time in seconds.
+Plan = collections.namedtuple('Plan', 'name log acquire points settle '
+                              'finish duration')
+
+defaultAcquire = {'COUN': 20, 'POIN': 20, 'bulk': False, 'target': None,
+                  'range': None}
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class RecipeError(ValueError):
+    """ A recipe that cannot be run, str() lists every problem found """
+
+    def __init__(self, problems):
+        self.problems = list(problems)
+        super(RecipeError, self).__init__('\n'.join(self.problems))
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def load(fileName):
+    """ Read a recipe file, YAML when the name ends in .yaml or .yml
+
+        Output: Recipe dictionary, not yet validated
+    """
+    with open(fileName) as F:
+        if os.path.splitext(fileName)[1].lower() in ('.yaml', '.yml'):
+            try:
+                import yaml
+            except ImportError:
+                raise RecipeError(['PyYAML is needed to read ' + fileName])
+            try:
+                recipe = yaml.safe_load(F)
+            except yaml.YAMLError as e:
+                raise RecipeError([fileName + ': ' + str(e)])
+        else:
+            try:
+                recipe = json.load(F)
+            except ValueError as e:
+                raise RecipeError([fileName + ': ' + str(e)])
+    if not isinstance(recipe, dict):
+        raise RecipeError([fileName + ': a recipe is a mapping of settings'])
+    return recipe
+
+
+def number(value, where, low=None, high=None, integer=False):
+    """ value as a float (or int), raising RecipeError with where in the
+        message when it is not a finite number in [low, high] """
+    try:
+        if isinstance(value, bool):
+            raise ValueError
+        out = float(value)
+        if not math.isfinite(out):
+            raise ValueError
+        if integer:
+            if out != int(out):
+                raise ValueError
+            out = int(out)
+    except (TypeError, ValueError, OverflowError):
+        kind = 'an integer' if integer else 'a number'
+        raise RecipeError([where + ' must be ' + kind + ', got ' +
+                           repr(value)])
+    if (low is not None and out < low) or (high is not None and out > high):
+        raise RecipeError([where + ' must be between ' + str(low) + ' and ' +
+                           str(high) + ', got ' + repr(value)])
+    return out
+
+
+def axis(values, key, where):
+    """ Setpoints of a [start, stop, step] sweep of key """
+    if not isinstance(values, (list, tuple)) or len(values) != 3:
+        raise RecipeError([where + ' must be [start, stop, step]'])
+    low, high = limits[key]
+    start = number(values[0], where + ' start', low, high, integer=True)
+    stop = number(values[1], where + ' stop', low, high, integer=True)
+    step = number(values[2], where + ' step', integer=True)
+    if step == 0 or (stop - start)*step < 0:
+        raise RecipeError([where + ' step ' + str(step) + ' does not go from '
+                           + str(start) + ' to ' + str(stop)])
+    points = sweepPoints(start, stop, step)
+    outside = [p for p in points if not low <= p <= high]
+    if outside:
+        raise RecipeError([where + ' goes outside ' + str(low) + ' to ' +
+                           str(high) + ' at ' + str(outside[0])])
+    return points
+
+
+def validate(recipe):
+    """ Check a recipe, returns a copy with every value converted and
+        defaults filled in, raises RecipeError listing all problems """
+    problems = []
+
+    def check(func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except RecipeError as e:
+            problems.extend(e.problems)
+
+    out = {'name': str(recipe.get('name', '')), 'log': recipe.get('log'),
+           'settle': check(number, recipe.get('settle', 0.1), 'settle', 0,
+                           3600)}
+    log = out['log']
+    if log is not None and not (isinstance(log, str) and log.strip()):
+        problems.append('log must be a file name, got ' + repr(log))
+    unknown = set(recipe) - set(['name', 'log', 'settle', 'acquire',
+                                 'steps'])
+    if unknown:
+        problems.append('Unknown settings: ' + ', '.join(sorted(unknown)))
+
+    acquire = dict(defaultAcquire)
+    given = recipe.get('acquire') or {}
+    if isinstance(given, dict):
+        acquire.update(given)
+    else:
+        problems.append('acquire must be a mapping of settings')
+    unknown = set(acquire) - set(defaultAcquire)
+    if unknown:
+        problems.append('Unknown acquire settings: ' +
+                        ', '.join(sorted(unknown)))
+    for key in ('COUN', 'POIN'):
+        acquire[key] = check(number, acquire[key], 'acquire ' + key, 1,
+                             3000, integer=True)
+    if not isinstance(acquire['bulk'], bool):
+        problems.append('acquire bulk must be true or false, got ' +
+                        repr(acquire['bulk']))
+    if acquire['target'] is not None:
+        acquire['target'] = check(number, acquire['target'],
+                                  'acquire target', 1e-6, 1)
+    rang = acquire['range']
+    if isinstance(rang, str) and rang.lower() == 'auto':
+        acquire['range'] = 'auto'
+    elif rang is not None:
+        rang = check(number, rang, 'acquire range')
+        if rang is not None and rang not in currentRanges:
+            problems.append('acquire range must be "auto" or one of ' +
+                            ', '.join('%g' % r for r in currentRanges))
+        acquire['range'] = rang
+    out['acquire'] = acquire
+
+    steps = recipe.get('steps')
+    if not isinstance(steps, list) or not steps:
+        problems.append('steps must be a non-empty list')
+        steps = []
+    out['steps'] = []
+    for i, step in enumerate(steps):
+        where = 'step ' + str(i + 1)
+        if not isinstance(step, dict):
+            problems.append(where + ' must be a mapping')
+            continue
+        kind = step.get('type')
+        where += ' (' + str(kind) + ')'
+        new = {'type': kind}
+        if 'settle' in step:
+            new['settle'] = check(number, step['settle'], where + ' settle',
+                                  0, 3600)
+        if kind == 'set':
+            for key in ('wave', 'volt'):
+                if key in step:
+                    new[key] = check(number, step[key], where + ' ' + key,
+                                     *limits[key])
+            if 'shutter' in step:
+                shutter = str(step['shutter']).lower()
+                if shutter not in ('open', 'closed', 'close'):
+                    problems.append(where + ' shutter must be open or '
+                                    'closed')
+                new['shutter'] = shutter.startswith('o')
+        elif kind == 'repeat':
+            new['points'] = check(number, step.get('points'),
+                                  where + ' points', 1, 1e7, integer=True)
+            new['dwell'] = check(number, step.get('dwell', 0.5),
+                                 where + ' dwell', 0, 3600)
+        elif kind in ('wave-sweep', 'volt-sweep'):
+            key = kind.split('-')[0]
+            new[key] = check(axis, [step.get('start'), step.get('stop'),
+                                    step.get('step')], key, where)
+        elif kind == 'grid':
+            new['wave'] = check(axis, step.get('wave'), 'wave',
+                                where + ' wave')
+            new['volt'] = check(axis, step.get('volt'), 'volt',
+                                where + ' volt')
+        else:
+            problems.append(where + ' type must be set, repeat, wave-sweep,'
+                            ' volt-sweep or grid')
+        out['steps'].append(new)
+
+    if problems:
+        raise RecipeError(problems)
+    return out
+
+
+def compilePlan(recipe):
+    """ Validate a recipe and flatten it into a Plan
+
+        Every measured point carries all setpoints given so far, so a point
+        only moves the axes that change.  'set' steps measure nothing, their
+        setpoints are applied with the next measured point.
+    """
+    recipe = validate(recipe)
+    state = collections.OrderedDict()
+    points, settle = [], []
+
+    def add(update, wait):
+        state.update(update)
+        points.append(tuple(state.items()))
+        settle.append(wait)
+
+    for step in recipe['steps']:
+        wait = step.get('settle', recipe['settle'])
+        kind = step['type']
+        if kind == 'set':
+            for key in ('wave', 'volt', 'shutter'):
+                if key in step:
+                    state[key] = step[key]
+        elif kind == 'repeat':
+            for i in range(step['points']):
+                add({}, step['dwell'])
+        elif kind in ('wave-sweep', 'volt-sweep'):
+            key = kind.split('-')[0]
+            for val in step[key]:
+                add({key: val}, wait)
+        elif kind == 'grid':
+            for point in gridPoints(step['wave'], step['volt']):
+                add(point, wait)
+    if not points:
+        raise RecipeError(['The recipe measures nothing, add a repeat, '
+                           'sweep or grid step'])
+    last = dict(points[-1])
+    finish = tuple((key, val) for key, val in state.items()
+                   if last.get(key) != val)
+
+    acquire = recipe['acquire']
+    count = acquire['COUN'] if not acquire['target'] else 10
+    perPoint = count*readTime + pointTime
+    duration = (moveTime([dict(p) for p in points]) + sum(settle) +
+                len(points)*perPoint)
+    return Plan(recipe['name'], recipe['log'],
+                tuple(sorted(acquire.items())), tuple(points), tuple(settle),
+                finish, duration)
+
+
+def shutterMover(mono):
+    """ (start, wait) pair for the shutter setpoint of a plan """
+    def start(shutter):
+        mono.write(b'SHUTTER O' if shutter else b'SHUTTER C')
+
+    def wait(shutter):
+        pass
+    return start, wait
+
+
+def planSweep(plan, pico, mono, record):
+    """ PipelinedSweep that runs plan, call run() on the acquisition thread
+
+        Input:
+
+            plan: From compilePlan
+
+            pico: Connected controlPA
+
+            mono: Connected controlMC, or None when the plan only sets the
+                  voltage
+
+          record: As for PipelinedSweep
+
+        Output: PipelinedSweep
+    """
+    movers = {'volt': voltMover(pico)}
+    if mono is not None:
+        movers['wave'] = waveMover(mono)
+        movers['shutter'] = shutterMover(mono)
+    used = set(key for point in plan.points + (plan.finish,)
+               for key, val in point)
+    missing = used - set(movers)
+    if missing:
+        raise RecipeError(['The monochromator is needed for ' +
+                           ', '.join(sorted(missing))])
+    acquire = dict(plan.acquire)
+    auto = acquire['range'] == 'auto'
+    return PipelinedSweep([dict(p) for p in plan.points], movers, pico,
+                          record, settle=list(plan.settle),
+                          bulk=acquire['bulk'], COUN=acquire['COUN'],
+                          POIN=acquire['POIN'], target=acquire['target'],
+                          autorange=AutoRange() if auto else None,
+                          rang=None if auto else acquire['range'],
+                          finish=dict(plan.finish))
+
+
+def describe(plan):
+    """ One line summary of a plan """
+    minutes, seconds = divmod(int(round(plan.duration)), 60)
+    return (str(len(plan.points)) + ' points, about ' + str(minutes) +
+            ' min ' + str(seconds) + ' s')
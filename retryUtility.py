@@ -0,0 +1,214 @@
+"""
+Retries with backoff and a circuit breaker for transient GPIB and ODevice
+errors.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import functools
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def transient(error):
+    """ True for errors worth retrying: bus timeouts and other I/O errors,
+        including pyvisa's, which do not derive from IOError.  Not the
+        TimeoutError of waitBufferFull or waitSettled, which already waited
+        up to 30 s for the instrument. """
+    if isinstance(error, TimeoutError):
+        return False
+    return (isinstance(error, OSError) or
+            type(error).__module__.startswith('pyvisa'))
+
+
+def recoverable(error):
+    """ True for errors after which a long run skips the point and carries
+        on: transient errors the retries did not fix, an open breaker and a
+        buffer or grating that did not finish in time """
+    return transient(error) or isinstance(error, (CircuitOpen, TimeoutError))
+
+
+def retried(method):
+    """ Decorator running a controlPA or controlMC method through the
+        instance's Retry, self.retry """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        return self.retry.call(method, self, *args, **kwargs)
+    return wrapper
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class CircuitOpen(RuntimeError):
+    """ Raised instead of calling an instrument whose breaker is open,
+        remaining is the number of seconds until the next try """
+
+    def __init__(self, message, remaining=0.):
+        super(CircuitOpen, self).__init__(message)
+        self.remaining = remaining
+
+
+class Breaker:
+    """ Circuit breaker of one instrument.
+
+        'closed': calls go through.  After threshold calls in a row failed
+        (every retry included) it opens.  'open': calls fail at once with
+        CircuitOpen, so a dead bus is not hammered and the GUI stays
+        responsive.  After cooldown seconds it is 'half-open': the next call
+        goes through as a trial, closing the breaker when it succeeds and
+        opening it again when it fails.  Other calls get CircuitOpen until
+        the trial is over.
+
+        onChange(state) is called on every change, from the thread making
+        the call.
+    """
+    def __init__(self, threshold=3, cooldown=30.):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.failures = 0       # Failed calls in a row
+        self.openedAt = 0.
+        self.trial = False      # A half-open trial call is running
+        self.onChange = None
+        self.lock = threading.Lock()
+
+    def _set(self, state):
+        if state != self.state:
+            self.state = state
+            if self.onChange is not None:
+                self.onChange(state)
+
+    def allow(self):
+        """ True when a call may go ahead """
+        with self.lock:
+            if self.state == 'open':
+                if time.time() - self.openedAt < self.cooldown:
+                    return False
+                self._set('half-open')
+            elif self.state == 'closed':
+                return True
+            if self.trial:
+                return False
+            self.trial = True
+            return True
+
+    def remaining(self):
+        """ Seconds until an open breaker lets a call through """
+        return max(self.openedAt + self.cooldown - time.time(), 0.)
+
+    def release(self):
+        """ End the trial call, when it raised a non-transient error the
+            next call becomes the trial """
+        with self.lock:
+            self.trial = False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.trial = False
+            self._set('closed')
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial = False
+            if self.state == 'half-open' or self.failures >= self.threshold:
+                self.openedAt = time.time()
+                self._set('open')
+
+
+class Retry:
+    """ Bounded retries with exponential backoff for one instrument.
+
+        A call that raises a transient error is tried again up to attempts
+        times in all, waiting delay, delay*factor, ... (at most maxDelay)
+        seconds and calling recover (e.g. reopening the session) before each
+        new attempt.  Other errors are raised straight away.  Calls that
+        still fail count towards opening the breaker.  Calls made from
+        inside a call on the same thread (e.g. a @retried setRange within a
+        retried arm) run once, their errors are retried by the outer call.
+
+        Input:
+
+              name: Instrument name used in messages
+
+          attempts: Tries per call, including the first
+
+             delay: Seconds before the first retry
+
+            factor: Backoff multiplier per retry
+
+          maxDelay: Longest wait between tries in seconds
+
+           recover: Called before every retry, None for nothing
+
+           breaker: Breaker, a new one by default
+    """
+    def __init__(self, name, attempts=3, delay=0.1, factor=4., maxDelay=5.,
+                 recover=None, breaker=None):
+        self.name = name
+        self.attempts = attempts
+        self.delay = delay
+        self.factor = factor
+        self.maxDelay = maxDelay
+        self.recover = recover
+        self.breaker = breaker if breaker is not None else Breaker()
+        self.local = threading.local()  # depth: calls running on a thread
+
+    def backoff(self, attempt):
+        """ Seconds to wait before retry number attempt (1, 2, ...) """
+        return min(self.delay*self.factor**(attempt - 1), self.maxDelay)
+
+    def call(self, func, *args, **kwargs):
+        """ func(*args, **kwargs), retried on transient errors """
+        return self._run(func, args, kwargs, 0, None)
+
+    def after(self, error, func, *args, **kwargs):
+        """ As call, for a func whose first attempt already raised error """
+        if not transient(error):
+            raise error
+        return self._run(func, args, kwargs, 1, error)
+
+    def _run(self, func, args, kwargs, first, error):
+        depth = getattr(self.local, 'depth', 0)
+        if depth:
+            return func(*args, **kwargs)
+        if not self.breaker.allow():
+            if self.breaker.state == 'half-open':
+                raise CircuitOpen(self.name + ' paused after repeated '
+                                  'errors, trying again')
+            remaining = self.breaker.remaining()
+            raise CircuitOpen(self.name + ' paused after repeated errors, '
+                              'next try in %.0f s' % remaining, remaining)
+        trial = self.breaker.state == 'half-open'
+        self.local.depth = 1
+        try:
+            return self._attempts(func, args, kwargs, first, error)
+        finally:
+            self.local.depth = 0
+            if trial:
+                self.breaker.release()
+
+    def _attempts(self, func, args, kwargs, first, error):
+        for attempt in range(first, self.attempts):
+            try:
+                if attempt:
+                    wait = self.backoff(attempt)
+                    print(self.name + ': ' + repr(error) + ', retry ' +
+                          str(attempt) + ' in %.2f s' % wait)
+                    time.sleep(wait)
+                    if self.recover is not None:
+                        self.recover()
+                out = func(*args, **kwargs)
+            except Exception as e:
+                if not transient(e):
+                    raise
+                error = e
+                continue
+            self.breaker.success()
+            return out
+        self.breaker.failure()
+        raise error
@@ -0,0 +1,186 @@
+"""
+Sample layout of the live traces, the RingBuffer holding the latest
+samples and the PeakDecimator drawing long histories from them.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+
+# ----------------------------------------------------------------------------
+# Sample layout shared by the GUI traces and the data files
+# ----------------------------------------------------------------------------
+sampleDtype = np.dtype([('time', 'f8'),   # Seconds since the epoch
+                        ('piam', 'f8'),   # Current [Amps]
+                        ('volt', 'f8'),   # Source voltage [V]
+                        ('wave', 'f8'),   # Wavelength [nm]
+                        ('rang', 'f8'),   # Current range [Amps]
+                        ('sem', 'f8')])   # Standard error of piam [Amps]
+
+
+def sampleRows(new_time, result, volt, wave, rang, bulk=False):
+    """ Samples of one acquisition in sampleDtype order
+
+        Input:
+
+          new_time: Seconds since the epoch the acquisition started
+
+            result: Mean current, or BufferData from controlPA
+
+              bulk: One sample per BufferData reading, otherwise the mean
+
+        Output: (mean) sample, list of sample tuples
+    """
+    if hasattr(result, 'read'):
+        sample = (new_time, result.mean, volt, wave, rang, result.sem)
+        if bulk:
+            return sample, [(new_time + stamp, read, volt, wave, rang,
+                             result.sem)
+                            for stamp, read in zip(result.time, result.read)]
+    else:
+        sample = (new_time, result, volt, wave, rang, np.nan)
+    return sample, [sample]
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class RingBuffer:
+    """ Preallocated first-in first-out buffer of samples.
+
+        Every row is stored twice, at i and i + size, so the samples in time
+        order are always one contiguous slice of the storage and view never
+        copies.  Appending is O(1) regardless of size.
+    """
+    def __init__(self, size, dtype=sampleDtype):
+        self.size = int(size)
+        self.data = np.zeros(2*self.size, dtype=dtype)
+        self.index = 0  # Position the next row is written to
+        self.count = 0  # Number of valid rows, at most size
+
+    def __len__(self):
+        return self.count
+
+    def append(self, row):
+        """ Add one sample, row is a tuple in dtype field order """
+        self.data[self.index] = row
+        self.data[self.index + self.size] = row
+        self.index = (self.index + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def extend(self, rows):
+        """ Add many samples at once, rows is an array of the buffer dtype """
+        rows = np.asarray(rows, dtype=self.data.dtype)[-self.size:]
+        pos = (self.index + np.arange(len(rows))) % self.size
+        self.data[pos] = rows
+        self.data[pos + self.size] = rows
+        self.index = (self.index + len(rows)) % self.size
+        self.count = min(self.count + len(rows), self.size)
+
+    def view(self):
+        """ Oldest to newest samples, a view into the buffer not a copy """
+        if self.count < self.size:
+            return self.data[:self.count]
+        return self.data[self.index:self.index + self.size]
+
+    def clear(self):
+        self.index = 0
+        self.count = 0
+
+
+class PeakDecimator:
+    """ Running minimum and maximum of fixed size blocks of samples.
+
+        Kept next to a RingBuffer so a long history can be drawn from at most
+        size/block blocks without scanning the raw samples every frame.
+        Columns are fields of sampleDtype.
+    """
+    def __init__(self, size, block=1000, columns=('piam', 'volt', 'wave')):
+        self.block = int(block)
+        self.columns = columns
+        self.index = [sampleDtype.names.index(c) for c in columns]
+        fields = [('time', 'f8')]
+        for c in columns:
+            fields += [(c + '_lo', 'f8'), (c + '_hi', 'f8')]
+        self.blocks = RingBuffer(int(size)//self.block + 1, dtype=fields)
+        self.count = 0  # Samples in the current, unfinished block
+        self.start = 0
+        self.lo = np.zeros(len(columns))
+        self.hi = np.zeros(len(columns))
+
+    def append(self, row):
+        """ Add one sample, row is a tuple in sampleDtype order """
+        values = [row[i] for i in self.index]
+        if self.count == 0:
+            self.start = row[0]
+            self.lo[:] = values
+            self.hi[:] = values
+        else:
+            np.minimum(self.lo, values, out=self.lo)
+            np.maximum(self.hi, values, out=self.hi)
+        self.count += 1
+        if self.count == self.block:
+            block = [self.start]
+            for lo, hi in zip(self.lo, self.hi):
+                block += [lo, hi]
+            self.blocks.append(tuple(block))
+            self.count = 0
+
+    def trace(self, data, column, x0=None, x1=None, maxPoints=4000):
+        """ Points to draw for one column between times x0 and x1
+
+            Input:
+
+                     data: Ordered samples, RingBuffer.view()
+
+                   column: Field to draw
+
+                   x0, x1: Visible time range, None for everything
+
+                maxPoints: Raw samples are returned when there are fewer than
+                           this many in the range, otherwise the minimum and
+                           maximum of at least maxPoints/2 buckets
+
+            Output: (x, y) arrays
+        """
+        x = data['time']
+        i0 = 0 if x0 is None else max(np.searchsorted(x, x0) - 1, 0)
+        i1 = len(x) if x1 is None else min(np.searchsorted(x, x1) + 1, len(x))
+        if i1 - i0 <= maxPoints:
+            return x[i0:i1], data[column][i0:i1]
+
+        #  Finished blocks only when they are still fine enough to give
+        #  maxPoints/2 buckets, else decimate the visible samples directly
+        stride = (i1 - i0)//(maxPoints//2)
+        if stride < self.block or len(self.blocks) == 0:
+            starts = np.arange(0, i1 - i0, stride)
+            y = data[column][i0:i1]
+            return self._pairs(x[i0:i1][starts],
+                               np.minimum.reduceat(y, starts),
+                               np.maximum.reduceat(y, starts))
+
+        #  Whole blocks from the decimated history, the samples after the
+        #  last finished block straight from the raw data.  Once the buffer
+        #  wrapped the first block may start before the oldest sample left.
+        blocks = self.blocks.view()
+        t = blocks['time']
+        j0 = max(np.searchsorted(t, x[i0]) - 1, 0)
+        j1 = np.searchsorted(t, x[i1 - 1])
+        tail = max(i0, len(x) - self.count) if j1 == len(t) else i1
+        xs, ys = self._pairs(np.maximum(t[j0:j1], x[i0]),
+                             blocks[column + '_lo'][j0:j1],
+                             blocks[column + '_hi'][j0:j1])
+        return (np.concatenate([xs, x[tail:i1]]),
+                np.concatenate([ys, data[column][tail:i1]]))
+
+    @staticmethod
+    def _pairs(t, lo, hi):
+        """ Minimum then maximum of every bucket, both at its start time """
+        ys = np.empty(2*len(t))
+        ys[0::2] = lo
+        ys[1::2] = hi
+        return np.repeat(t, 2), ys
+
+    def clear(self):
+        self.blocks.clear()
+        self.count = 0
@@ -0,0 +1,82 @@
+"""
+Deposition stations run from one process.  A station is one picoammeter and,
+optionally, the monochromator lighting its photocathode.  The list is read
+from the JSON file named by the DEPGUI_STATIONS environment variable, e.g.
+
+    [{"name": "Station 1", "address": "GPIB0::22::INSTR", "mono": true},
+     {"name": "Station 2", "address": "GPIB1::22::INSTR", "mono": false}]
+
+mono is true for the monochromator in the default ODevice directory, false
+for none, or the directory of the ODevice library of that station.  Put the
+picoammeters on separate interfaces (GPIB0, GPIB1, ...) so they can be
+read at the same time, every station has its own acquisition thread.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import collections
+import json
+import os
+
+#  One station: name shown in the GUI and used in log file names, VISA
+#  address of the picoammeter and the mono setting described above
+Station = collections.namedtuple('Station', 'name address mono')
+
+defaultStations = (Station('Station 1', 'GPIB0::22::INSTR', True),)
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def load(fileName=''):
+    """ Stations listed in fileName, defaultStations when it is empty
+
+        Output: Tuple of Station, raises ValueError listing the problems of
+                an invalid file
+    """
+    if not fileName:
+        return defaultStations
+    with open(fileName) as F:
+        try:
+            entries = json.load(F)
+        except ValueError as e:
+            raise ValueError(fileName + ': ' + str(e))
+    if not isinstance(entries, list) or not entries:
+        raise ValueError(fileName + ': expected a non-empty list of stations')
+
+    problems = []
+    stations = []
+    for i, entry in enumerate(entries):
+        where = 'station ' + str(i + 1)
+        if not isinstance(entry, dict) or 'address' not in entry:
+            problems.append(where + ' needs at least an address')
+            continue
+        unknown = set(entry) - set(Station._fields)
+        if unknown:
+            problems.append(where + ' has unknown settings: ' +
+                            ', '.join(sorted(unknown)))
+        mono = entry.get('mono', False)
+        if not isinstance(mono, (bool, str)):
+            problems.append(where + ' mono must be true, false or a '
+                            'directory')
+        stations.append(Station(str(entry.get('name', 'Station ' +
+                                                str(i + 1))),
+                                str(entry['address']), mono))
+    for field in ('name', 'address'):
+        seen = collections.Counter(getattr(s, field) for s in stations)
+        for value, count in seen.items():
+            if count > 1:
+                problems.append(field + ' ' + value + ' is used ' +
+                                str(count) + ' times')
+    if problems:
+        raise ValueError(fileName + ':\n' + '\n'.join(problems))
+    return tuple(stations)
+
+
+def logName(fileName, station, count):
+    """ Log file of station, the name with the station added when there
+        is more than one station, e.g. run.dlog -> run_Station_2.dlog """
+    if count < 2:
+        return fileName
+    base, ext = os.path.splitext(fileName)
+    return base + '_' + station.name.replace(' ', '_') + ext
@@ -0,0 +1,586 @@
+"""
+Parametric studies: setpoint lists, SweepEngine that runs them with pause
+and abort, PipelinedSweep overlapping instrument moves with picoammeter
+setup and the asyncio asyncSweep.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import numpy as np
+import asyncio
+import threading
+import time
+
+from retryUtility import CircuitOpen, recoverable, transient
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def sweepPoints(start, stop, step):
+    """ Integer setpoints from start towards stop in steps of step.  stop is
+        included when the step lands on it, the sweep never goes past it.
+
+        Input:
+
+          start, stop, step: Sweep limits and step size
+
+        Output: List of ints
+    """
+    start, stop, step = int(start), int(stop), int(step)
+    return list(range(start, stop + (1 if step > 0 else -1), step))
+
+
+#  Cost of moving each axis in seconds: (per move, per unit travelled).  The
+#  grating turns at about 200 nm/s; the source voltage is set by a couple of
+#  GPIB writes whatever the step.
+moveCosts = {'wave': (0.05, 1/200.),
+             'volt': (0.02, 0.)}
+
+
+def moveTime(points, costs=moveCosts):
+    """ Estimated time spent moving between the points of a study
+
+        Input:
+
+          points: List of point dicts as passed to SweepEngine
+
+           costs: {key: (seconds per move, seconds per unit)}
+
+        Output: Seconds
+    """
+    total = 0.
+    last = {}
+    for point in points:
+        for key, val in point.items():
+            if key in last and last[key] != val:
+                perMove, perUnit = costs.get(key, (0., 0.))
+                total += perMove + perUnit*abs(val - last[key])
+        last = point
+    return total
+
+
+def serpentine(slowKey, slow, fastKey, fast):
+    """ Grid points, fast axis reversed on every other row of the slow axis
+        so it never jumps back to its start """
+    points = []
+    for i, s in enumerate(slow):
+        for f in (fast if i % 2 == 0 else fast[::-1]):
+            points.append({slowKey: s, fastKey: f})
+    return points
+
+
+def gridPoints(waves, volts, costs=moveCosts):
+    """ Serpentine traversal of a wavelength x voltage grid, with the slow
+        (outer) axis chosen to minimise moveTime
+
+        Input:
+
+          waves, volts: Setpoints of each axis, e.g. from sweepPoints
+
+                 costs: Move costs passed to moveTime
+
+        Output: List of {'wave': w, 'volt': v} dicts
+    """
+    orders = [serpentine('wave', list(waves), 'volt', list(volts)),
+              serpentine('volt', list(volts), 'wave', list(waves))]
+    return min(orders, key=lambda points: moveTime(points, costs))
+
+
+def waveActuator(mono):
+    """ Returns a function that moves the monochromator to a wavelength and
+        waits for the grating to settle """
+    def goWave(wave):
+        mono.goWave(wave)
+    return goWave
+
+
+def waveMover(mono):
+    """ (start, wait) pair for PipelinedSweep: start sends GOWAVE and returns
+        at once, wait blocks until the grating has settled """
+    def start(wave):
+        mono.goWave(wave, wait=False)
+
+    def wait(wave):
+        mono.waitSettled(wave)
+    return start, wait
+
+
+def voltMover(pico):
+    """ (start, wait) pair for PipelinedSweep, the source voltage is set
+        straight away so there is nothing to wait for """
+    def start(volt):
+        pico.setVoltage(volt)
+
+    def wait(volt):
+        pass
+    return start, wait
+
+
+def voltActuator(pico):
+    """ Returns a function that sets the picoammeter source voltage """
+    def setVolt(volt):
+        print(pico.setVoltage(volt))
+    return setVolt
+
+async def asyncSweep(points, pico, mono, record, settle=0.1, COUN=20,
+                     POIN=20, bulk=False):
+    """ Wavelength and/or voltage sweep as a coroutine.
+
+        The moves to each point and arming the picoammeter are awaited
+        together, so the grating turns while the 6487 is set up, with both
+        instruments driven from the one event loop (see asyncDevice.py and
+        asyncQt.py).  Cancel the task to abort, the picoammeter is left with
+        zero check on.  For scripts and benchAcq.py --async only: the calls
+        run on the io threads of the controllers, not serialised with an
+        AcqWorker driving the same instruments, and are not retried.  The
+        GUI runs its sweeps with PipelinedSweep.
+
+        Input:
+
+          points: As for SweepEngine, keys 'wave' and/or 'volt'
+
+            pico: controlPA
+
+            mono: controlMC, may be None for voltage sweeps
+
+          record: record(point, time, result) is called with every
+                  readMean (float) or readBuffer (BufferData) result, its
+                  return value is stored
+
+          settle: Seconds between the end of a move and the measurement
+
+        COUN, POIN, bulk: As for aquireAsync
+
+        Output: List of (point, sample)
+    """
+    results = []
+    last = {}
+    try:
+        for point in points:
+            steps = [pico.armAsync(COUN, POIN, bulk)]
+            if 'wave' in point and point['wave'] != last.get('wave'):
+                steps.append(mono.goWaveAsync(point['wave']))
+            if 'volt' in point and point['volt'] != last.get('volt'):
+                steps.append(pico.setVoltageAsync(point['volt']))
+            await asyncio.gather(*steps)
+            last = point
+
+            await asyncio.sleep(settle)
+            start = time.time()
+            await pico.measureAsync()
+            result = await pico.readAsync(bulk)
+            results.append((point, record(point, start, result)))
+    except asyncio.CancelledError:
+        await pico.io.call(pico.disarm)
+        raise
+    return results
+
+# ----------------------------------------------------------------------------
+# Class
+# ----------------------------------------------------------------------------
+class SweepEngine:
+    """ Steps through a list of setpoints and takes a measurement at each.
+
+        Each point is a dict such as {'wave': 400} or {'wave': 400,
+        'volt': 10}; for every key that changed since the previous point the
+        matching actuator is called with the new value, then the engine waits
+        settle seconds (one number, or a list with one per point) and calls
+        acquire.  run blocks, so it is normally
+        executed on the acquisition thread, pause/resume/abort may be called
+        from any thread.
+
+        Callbacks (all optional, called from the thread executing run):
+
+          onStep(index, point, sample): After every measurement
+
+          onProgress(done, total): After every measurement
+
+          onFinish(state): 'done', 'aborted' or 'error'
+
+          onIdle(): Repeatedly while paused
+    """
+    def __init__(self, points, actuators, acquire, settle=0.1):
+        self.points = list(points)
+        self.actuators = actuators
+        self.acquire = acquire
+        self.settle = settle
+        self.results = []
+        self.state = 'idle'
+
+        self.onStep = None
+        self.onProgress = None
+        self.onFinish = None
+        self.onIdle = None
+
+        self._resume = threading.Event()
+        self._resume.set()
+        self._abort = threading.Event()
+
+    def run(self):
+        self.state = 'running'
+        try:
+            self._run()
+        except Exception:
+            self.state = 'error'
+            if self.onFinish is not None:
+                self.onFinish(self.state)
+            raise
+        self.state = 'aborted' if self._abort.is_set() else 'done'
+        if self.onFinish is not None:
+            self.onFinish(self.state)
+        return self.results
+
+    def _run(self):
+        total = len(self.points)
+        last = {}
+        for index, point in enumerate(self.points):
+            if not self.checkpoint():
+                return
+            for key, val in point.items():
+                if last.get(key) != val:
+                    self.actuators[key](val)
+            last = point
+
+            #  Settling time, returns early on abort
+            if (self._abort.wait(self.settleTime(index)) or
+                    not self.checkpoint()):
+                return
+            sample = self.acquire()
+            self.results.append((point, sample))
+
+            if self.onStep is not None:
+                self.onStep(index, point, sample)
+            if self.onProgress is not None:
+                self.onProgress(index + 1, total)
+
+    def settleTime(self, index):
+        """ Seconds to settle before measuring point index """
+        if isinstance(self.settle, (list, tuple)):
+            return self.settle[index]
+        return self.settle
+
+    def checkpoint(self):
+        """ Blocks while paused, returns False once aborted """
+        while not self._resume.wait(0.05):
+            if self.onIdle is not None:
+                self.onIdle()
+        return not self._abort.is_set()
+
+    def pause(self):
+        if self.state == 'running':
+            self.state = 'paused'
+            self._resume.clear()
+
+    def resume(self):
+        if self.state == 'paused':
+            self.state = 'running'
+            self._resume.set()
+
+    def abort(self):
+        self._abort.set()
+        self._resume.set()
+
+    def active(self):
+        return self.state in ('idle', 'running', 'paused')
+
+
+class GridData:
+    """ Mean current of a grid scan indexed by wavelength and voltage.
+
+        piam[i, j] and time[i, j] belong to waves[i] and volts[j], points not
+        measured (e.g. after an abort) are NaN.  save writes the arrays to an
+        .npz file, read it back with np.load or GridData.load.
+    """
+    def __init__(self, waves, volts):
+        self.waves = np.array(waves, dtype=float)
+        self.volts = np.array(volts, dtype=float)
+        self.piam = np.full((len(self.waves), len(self.volts)), np.nan)
+        self.time = np.full(self.piam.shape, np.nan)
+        self._wave = {w: i for i, w in enumerate(self.waves)}
+        self._volt = {v: j for j, v in enumerate(self.volts)}
+
+    def add(self, point, sample):
+        """ Store the (time, current, ...) sample measured at point """
+        i = self._wave[float(point['wave'])]
+        j = self._volt[float(point['volt'])]
+        self.time[i, j] = sample[0]
+        self.piam[i, j] = sample[1]
+
+    def addResults(self, results):
+        """ Store every (point, sample) of SweepEngine.results """
+        for point, sample in results:
+            self.add(point, sample)
+
+    def save(self, fileName):
+        np.savez(fileName, wave=self.waves, volt=self.volts, piam=self.piam,
+                 time=self.time)
+
+    @classmethod
+    def load(cls, fileName):
+        saved = np.load(fileName)
+        grid = cls(saved['wave'], saved['volt'])
+        grid.piam[:] = saved['piam']
+        grid.time[:] = saved['time']
+        return grid
+
+
+class PipelinedSweep(SweepEngine):
+    """ SweepEngine that overlaps the work of the two instruments.
+
+        SweepEngine does move, settle, configure, measure, read back strictly
+        in turn.  Here the picoammeter is armed (trigger model and trace
+        buffer set up, zero check off) while the movers run, and the move to
+        the next point is started as soon as the readings of the current one
+        are in the buffer, before they are read back and recorded:
+
+            move 0 | arm | wait | settle | measure 0 | move 1 | read 0 | arm
+            | wait | settle | measure 1 | ...
+
+        Input:
+
+            points: As for SweepEngine
+
+            movers: {key: (start, wait)}, start(value) begins a move and
+                    returns at once, wait(value) blocks until it is done,
+                    see waveMover and voltMover
+
+              pico: controlPA used for the measurements
+
+            record: record(point, time, result) is called with the start time
+                    and the readMean (float) or readBuffer (BufferData) result
+                    of every point, its return value is the stored sample
+
+            settle: Seconds between the end of a move and the measurement,
+                    one number or a list with one per point
+
+              bulk: Read the whole buffer with readBuffer instead of the mean
+
+        COUN, POIN: Readings per point and buffer size, as in aquireData
+
+            target: Relative standard error for adaptive sampling, as in
+                    aquireAdaptive blocks of readings are taken until it is
+                    reached or there are COUN readings, before the next move
+                    starts.  Implies bulk.
+
+         autorange: autoRange.AutoRange picking the current range of each
+                    point, keyed by the sorted point items.  Points that
+                    were out of range are measured again before the next
+                    move starts.
+
+              rang: Fixed current range set before the first point, None to
+                    keep the present one
+
+            finish: Setpoints moved to once the last point is measured or
+                    the sweep is aborted, e.g. {'shutter': False}
+
+        A point whose move or measurement still fails after the retries
+        (see retryUtility.recoverable) is recorded with a NaN current and
+        the sweep goes on with the next one, other errors end the sweep.
+    """
+    def __init__(self, points, movers, pico, record, settle=0.1, bulk=False,
+                 COUN=20, POIN=20, target=None, block=10, autorange=None,
+                 rang=None, finish=None):
+        super(PipelinedSweep, self).__init__(points, {}, None, settle)
+        self.movers = movers
+        self.pico = pico
+        self.record = record
+        self.bulk = bulk or bool(target)
+        self.target = target
+        self.COUN = COUN
+        self.POIN = POIN
+        self.block = block
+        self.autorange = autorange
+        self.rang = rang
+        self.finish = finish or {}
+        self.armed = False
+
+    def _arm(self, point=None):
+        if self.autorange is not None and point is not None:
+            self.autorange.select(self.pico, tuple(sorted(point.items())))
+        if self.target:
+            count = min(self.block, self.COUN, self.POIN)
+        else:
+            count = self.COUN
+        self.pico.arm(count, self.POIN, bulk=self.bulk)
+        self.armed = True
+
+    def _move(self, point, last):
+        """ Start the moves to point, returns the wait functions """
+        waits = []
+        for key, val in point.items():
+            if last.get(key) != val:
+                start, wait = self.movers[key]
+                start(val)
+                waits.append((wait, val))
+        return waits
+
+    def _run(self):
+        if self.rang is not None:
+            self.pico.setRange(self.rang)
+        self._sweep()
+        for wait, val in self._move(self.finish, {}):
+            wait(val)
+
+    def _sweep(self):
+        total = len(self.points)
+        if total == 0:
+            return
+        failed = None  # Error that stopped the current point
+        try:
+            try:
+                waits = self._prepare(self.points[0], {})
+            except Exception as e:
+                failed = self._failed(e)
+            for index, point in enumerate(self.points):
+                if failed is None:
+                    try:
+                        for wait, val in waits:
+                            wait(val)
+                    except Exception as e:
+                        failed = self._failed(e)
+                if (not self.checkpoint() or
+                        self._abort.wait(self.settleTime(index)) or
+                        not self.checkpoint()):
+                    return
+                start = time.time()
+                moved, waits = None, []
+                if failed is None:
+                    try:
+                        start, result, moved, waits = self._measure(index,
+                                                                    point)
+                    except Exception as e:
+                        failed = self._failed(e)
+                if failed is not None:
+                    result = np.nan
+                    print('Point ' + str(point) + ' skipped: ' + repr(failed))
+                    if isinstance(failed, CircuitOpen):
+                        self._abort.wait(failed.remaining)
+                sample = self.record(point, start, result)
+                self.results.append((point, sample))
+
+                if self.onStep is not None:
+                    self.onStep(index, point, sample)
+                if self.onProgress is not None:
+                    self.onProgress(index + 1, total)
+                if index + 1 < total:
+                    #  After a failure where the movers are is unknown, so
+                    #  every setpoint of the next point is sent again
+                    last = point if failed is None else {}
+                    failed = None
+                    try:
+                        waits = self._prepare(self.points[index + 1], last,
+                                              None if moved is None else waits)
+                    except Exception as e:
+                        failed = self._failed(e)
+        finally:
+            if self.armed:
+                self.pico.disarm()
+                self.armed = False
+
+    def _failed(self, error):
+        """ error if the point can be skipped, raises it otherwise """
+        if not recoverable(error):
+            raise error
+        return error
+
+    def _prepare(self, point, last, waits=None):
+        """ Start the moves from last to point, unless they were started
+            already (their waits given), and arm the picoammeter for it
+
+            Output: Wait functions of the moves
+        """
+        if waits is None:
+            waits = self._move(point, last)
+        self.pico.retry.call(self._arm, point)
+        return waits
+
+    def _measure(self, index, point):
+        """ Measure point, starting the move to the next one as soon as the
+            readings are in the buffer.  Transient errors measure it again
+            through the picoammeter's Retry.
+
+            Output: (start time, result, next point or None, waits of its
+                    moves)
+        """
+        start = time.time()
+        moved, waits = None, []
+        try:
+            self.pico.measure()
+            self.armed = False
+
+            #  The readings are in the buffer, so the next move can start
+            #  while they are read back, unless more may be needed
+            if self.target or self.autorange is not None:
+                result = self._read(point)
+            if index + 1 < len(self.points):
+                moved = self.points[index + 1]
+                waits = self._move(moved, point)
+            if not (self.target or self.autorange is not None):
+                result = self._read(point)
+        except Exception as e:
+            if not transient(e):
+                raise
+            start, result = self._measureAgain(index, moved, waits, e)
+            if moved is not None:
+                waits = self._move(moved, point)
+        return start, result, moved, waits
+
+    def _measureAgain(self, index, moved, waits, error):
+        """ Measure point index again after error, through the
+            picoammeter's Retry.  When the move to the next point (moved)
+            had already started the movers go back first.
+
+            Output: (start time, result)
+        """
+        point = self.points[index]
+        if moved is not None:
+            for wait, val in waits:
+                wait(val)
+            for wait, val in self._move(point, moved):
+                wait(val)
+            self._abort.wait(self.settleTime(index))
+
+        def again():
+            self._arm(point)
+            start = time.time()
+            self.pico.measure()
+            self.armed = False
+            return start, self._read(point)
+        return self.pico.retry.after(error, again)
+
+    def _readOnce(self):
+        if self.target:
+            return self.pico.refine(self.pico.readBuffer(), self.target,
+                                    self.COUN, self.POIN)
+        if self.bulk:
+            return self.pico.readBuffer()
+        return self.pico.readMean()
+
+    def _read(self, point):
+        """ Read back the measurement of point, measuring it again on
+            another range when autorange finds it out of range """
+        result = self._readOnce()
+        if self.autorange is None:
+            return result
+        tried = set([self.pico.range])
+        rang = self.autorange.check(self.pico, result)
+        while rang is not None and rang not in tried:
+            tried.add(rang)
+            self.pico.setRange(rang)
+            self._arm()
+            self.pico.measure()
+            self.armed = False
+            result = self._readOnce()
+            rang = self.autorange.check(self.pico, result)
+        self.autorange.update(tuple(sorted(point.items())), result)
+        return result
+
+    def checkpoint(self):
+        """ As SweepEngine.checkpoint, re-arming after a pause since queued
+            jobs may have used the picoammeter in the meantime """
+        paused = not self._resume.is_set()
+        go = super(PipelinedSweep, self).checkpoint()
+        if paused and go:
+            self.pico.retry.call(self._arm)
+        return go
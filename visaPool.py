@@ -0,0 +1,108 @@
+"""
+Process-wide VISA resource managers and sessions shared by every
+controlPA.
+"""
+
+# ----------------------------------------------------------------------------
+# Imports
+# ----------------------------------------------------------------------------
+import threading
+import time
+
+# ----------------------------------------------------------------------------
+# State
+#
+# One resource manager per backend and one open session per (backend,
+# address) for the whole process.  Creating a pyvisa.ResourceManager loads
+# the VISA library and every open_resource takes a GPIB handle, so controlPA
+# borrows them from here instead: reconnecting reuses a session that still
+# answers and closes one that does not before opening the next.
+# ----------------------------------------------------------------------------
+managers = {}   # backend: resource manager
+sessions = {}   # (backend, address): open session
+resources = {}  # backend: (time listed, tuple of resource names)
+listTTL = 10.   # Seconds a list_resources result is reused
+
+lock = threading.RLock()
+
+# ----------------------------------------------------------------------------
+# Functions
+# ----------------------------------------------------------------------------
+def resourceManager(backend=''):
+    """ The process-wide resource manager of backend
+
+        Input:
+
+          backend: pyvisa backend, '' for NI VISA or 'sim' for the simulator
+                   in instSim.py
+
+        Output: pyvisa.ResourceManager or instSim.SimResourceManager
+    """
+    with lock:
+        if backend not in managers:
+            #  pyvisa is only imported here as loading it and the VISA
+            #  library takes a while
+            if backend == 'sim':
+                from instSim import SimResourceManager
+                managers[backend] = SimResourceManager()
+            else:
+                import pyvisa
+                managers[backend] = pyvisa.ResourceManager(backend)
+        return managers[backend]
+
+
+def listResources(backend='', refresh=False):
+    """ Resource names seen by backend, rescanned at most every listTTL
+        seconds unless refresh is set """
+    with lock:
+        listed, names = resources.get(backend, (None, ()))
+        if refresh or listed is None or time.time() - listed > listTTL:
+            names = tuple(resourceManager(backend).list_resources())
+            resources[backend] = (time.time(), names)
+        return names
+
+
+def openSession(address, backend='', reopen=False):
+    """ Pooled session of address, opened on first use
+
+        Input:
+
+          address: VISA resource name
+
+          backend: As for resourceManager
+
+           reopen: Close the pooled session and open a new one, e.g. after
+                   it stopped answering
+
+        Output: pyvisa resource
+    """
+    with lock:
+        key = (backend, address)
+        if reopen:
+            closeSession(address, backend)
+        if key not in sessions:
+            sessions[key] = resourceManager(backend).open_resource(address)
+        return sessions[key]
+
+
+def closeSession(address, backend=''):
+    """ Close and forget the pooled session of address, if any """
+    with lock:
+        inst = sessions.pop((backend, address), None)
+        if inst is not None:
+            try:
+                inst.close()
+            except Exception as e:
+                print('Closing ' + address + ' failed: ' + repr(e))
+
+
+def closeAll():
+    """ Close every pooled session and resource manager """
+    with lock:
+        for backend, address in list(sessions):
+            closeSession(address, backend)
+        for rm in managers.values():
+            if hasattr(rm, 'close'):
+                rm.close()
+        managers.clear()
+        resources.clear()